@@ -1,11 +1,23 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+from flask import Flask, render_template, request, redirect, url_for, jsonify, Response, stream_with_context, g, abort
 from apscheduler.schedulers.background import BackgroundScheduler
-from db import SessionLocal, MacEntry, LogEntry, tz_shanghai
-from collector import collect_snmp, collect_snmp_manual
+from db import (SessionLocal, MacEntry, MacInterval, LogEntry, DailySummary, DailyMac, tz_shanghai, STORAGE_MODE, get_mac_model,
+                mac_search_filter, distinct_dates, explain_query_plan, full_table_scans, RETENTION_DAYS, PARTITIONED,
+                partition_start, drop_partitions_before, drop_all_partitions, max_mac_entry_id, mac_time_range, IS_SQLITE)
+from collector import (collect_snmp, collect_snmp_manual, collect_due_devices, get_adaptive_config, get_trunk_config,
+                       sweep_progress)
+from tasks import TaskQueue, DEFAULT_TASK_WORKERS, DEFAULT_TASK_KEEP_DAYS
+import metrics
+from locations import location_index
+from cache import query_cache
+import base64
+import csv
 import datetime
-import threading
+import io
+import json
+import time
 import yaml
-from sqlalchemy import func, distinct
+from sqlalchemy import func, distinct, literal, tuple_, select
+import click
 
 app = Flask(__name__)
 
@@ -13,22 +25,92 @@ app = Flask(__name__)
 with open("config.yaml") as f:
     config = yaml.safe_load(f)
 
-# 存储后台采集任务的状态
-collection_tasks = {}
+# 后台任务队列：采集和清理排队串行执行，状态保存在 tasks 表
+task_config = config.get("tasks") or {}
+task_queue = TaskQueue(workers=task_config.get("workers", DEFAULT_TASK_WORKERS),
+                       keep_days=task_config.get("keep_days", DEFAULT_TASK_KEEP_DAYS))
+
+def submit_collection(message="开始采集..."):
+    """按配置文件采集；与正在排队或进行的配置网段采集合并"""
+    return task_queue.submit("collect", f"collect:{config['snmp']['network']}", run_collection_task, message=message)
+
+def submit_cleanup():
+    """清理过期数据；已有清理任务未结束时直接返回那个任务"""
+    return task_queue.submit("cleanup", "cleanup:old", run_cleanup_task, message="开始清理旧数据...")
+
+def _old_data_query(db, Model, cutoff):
+    """早于 cutoff 的 MAC 记录（区间模式下按最后发现时间），走 timestamp 索引"""
+    return db.query(Model).filter(Model.timestamp < cutoff)
+
+def _by_date_query(db, Model, start_datetime, end_datetime, device_filter=""):
+    """时间段内（可选指定设备）的 MAC 记录，时间条件都是可以走索引的范围谓词"""
+    if Model is MacInterval:
+        # 区间模式：与所选时间段有交集的区间
+        query = db.query(MacInterval).filter(
+            MacInterval.last_seen >= start_datetime,
+            MacInterval.first_seen <= end_datetime
+        )
+    else:
+        query = db.query(MacEntry).filter(
+            MacEntry.timestamp >= start_datetime,
+            MacEntry.timestamp <= end_datetime
+        )
+    if device_filter:
+        query = query.filter(Model.device == device_filter)
+    return query
+
+def _logs_query(db, start_datetime=None, end_datetime=None):
+    """日志查询，可选按时间段筛选"""
+    query = db.query(LogEntry)
+    if start_datetime is not None:
+        query = query.filter(
+            LogEntry.timestamp >= start_datetime,
+            LogEntry.timestamp <= end_datetime
+        )
+    return query
+
+def _retention_cutoff():
+    """保留期的起点：RETENTION_DAYS 天前那一天的零点，按整天清理，与每日汇总表对齐"""
+    day = datetime.datetime.now(tz_shanghai).date() - datetime.timedelta(days=RETENTION_DAYS)
+    return tz_shanghai.localize(datetime.datetime.combine(day, datetime.time.min))
+
+def _retention_keep_from():
+    """清理后保留数据的起始日期；分区时只删除整个已过期的分区"""
+    day = _retention_cutoff().date()
+    return partition_start(day) if PARTITIONED else day
+
+def _summary_row_count(db, before=None):
+    """从每日汇总表累加记录数（before 之前的天）"""
+    query = db.query(func.coalesce(func.sum(DailySummary.row_count), 0))
+    if before is not None:
+        query = query.filter(DailySummary.day < before)
+    return query.scalar()
 
 def clean_old_data():
-    """清理超过30天的数据，返回删除的记录数"""
+    """清理超过保留期的数据，返回删除的记录数"""
     db = SessionLocal()
     try:
-        # 计算30天前的日期
-        thirty_days_ago = datetime.datetime.now(tz_shanghai) - datetime.timedelta(days=30)
+        cutoff = _retention_cutoff()
         
-        # 查询并删除旧数据
-        result = db.query(MacEntry).filter(MacEntry.timestamp < thirty_days_ago).delete()
+        if PARTITIONED:
+            # 分区模式：直接 DROP 过期的分区表，删除的行数从每日汇总表得到
+            keep_from = drop_partitions_before(db.connection(), _retention_keep_from())
+            result = _summary_row_count(db, keep_from)
+        else:
+            # 查询并删除旧数据（区间模式下删除最后发现时间早于保留期的区间）
+            keep_from = cutoff.date()
+            result = _old_data_query(db, get_mac_model(), cutoff).delete()
+        # 同时删掉对应的每日汇总
+        db.query(DailySummary).filter(DailySummary.day < keep_from).delete()
+        # 当天的 MAC 集合只在当天用到
+        db.query(DailyMac).filter(DailyMac.day < datetime.datetime.now(tz_shanghai).date()).delete()
         db.commit()
+        # 当前位置索引里最后发现时间早于保留期的 MAC 也一并删除
+        if location_index.prune(cutoff):
+            location_index.save()
         
         # 添加日志记录
-        db.add(LogEntry(message=f"清理了 {result} 条超过30天的旧数据"))
+        db.add(LogEntry(message=f"清理了 {result} 条超过{RETENTION_DAYS}天的旧数据"))
         db.commit()
         
         return result
@@ -38,8 +120,74 @@ def clean_old_data():
         db.commit()
         raise e
     finally:
+        query_cache.bump()
         db.close()
 
+# 列表页可排序的列 -> 模型属性；mac 按规范化的 mac_hex 排序，顺序相同但可以走索引
+SORT_COLUMNS = {'device': 'device', 'vlan': 'vlan', 'mac': 'mac_hex', 'port': 'port', 'timestamp': 'timestamp'}
+
+def _cached_count(key, query):
+    """返回查询的总行数，翻页时不必每次重新 count()；数据变化（采集或清理提交）后重新计数"""
+    def count():
+        started = time.perf_counter()
+        value = query.count()
+        metrics.COUNT_QUERY_SECONDS.observe(time.perf_counter() - started, key[0])
+        return value
+    return query_cache.get_or_compute(key, count)
+
+def _encode_cursor(value, row_id):
+    """把 (排序列的值, id) 编码成 URL 安全的游标"""
+    if isinstance(value, datetime.datetime):
+        value = {"dt": value.isoformat()}
+    raw = json.dumps([value, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def _decode_cursor(token):
+    """解析游标，格式不对时抛出 ValueError"""
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except Exception as e:
+        raise ValueError(f"无效的分页游标: {token}") from e
+    if isinstance(value, dict):
+        value = datetime.datetime.fromisoformat(value["dt"])
+    return value, int(row_id)
+
+def _keyset_page(query, Model, sort_attr, descending, per_page, after=None, before=None):
+    """按 (排序列, id) 做游标分页，返回 (本页结果, 上一页游标, 下一页游标)
+
+    after 取排在游标之后的一页，before 取排在游标之前的一页；
+    无论翻到第几页都只是一次索引定位加 LIMIT，不使用 OFFSET。
+    """
+    sort_column = getattr(Model, sort_attr)
+    key = tuple_(sort_column, Model.id)
+    backward = bool(before) and not after
+    token = before if backward else after
+    # 向前翻页时把比较和排序方向都反过来，取完再倒序
+    scan_desc = descending != backward
+
+    if token:
+        value, row_id = _decode_cursor(token)
+        bound = tuple_(literal(value, type_=sort_column.type), literal(row_id))
+        query = query.filter(key < bound if scan_desc else key > bound)
+
+    if scan_desc:
+        query = query.order_by(sort_column.desc(), Model.id.desc())
+    else:
+        query = query.order_by(sort_column.asc(), Model.id.asc())
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backward:
+        rows.reverse()
+    if not rows:
+        return rows, None, None
+
+    first = _encode_cursor(getattr(rows[0], sort_attr), rows[0].id)
+    last = _encode_cursor(getattr(rows[-1], sort_attr), rows[-1].id)
+    if backward:
+        return rows, first if has_more else None, last
+    return rows, first if token else None, last if has_more else None
+
 # 初始化调度器
 scheduler = BackgroundScheduler()
 
@@ -48,12 +196,26 @@ interval_minutes = config["schedule"]["interval_minutes"]
 cleanup_hour = config["schedule"]["cleanup_hour"]
 cleanup_minute = config["schedule"]["cleanup_minute"]
 
-# 使用配置的定时设置
-scheduler.add_job(func=collect_snmp, trigger="interval", minutes=interval_minutes)
+# 使用配置的定时设置；定时任务也进入任务队列，上一次采集还没结束时会合并到那次采集
+scheduler.add_job(func=submit_collection, args=["定时采集..."], trigger="interval", minutes=interval_minutes,
+                  max_instances=1, coalesce=True)
+# 自适应轮询：定期检查并采集已到轮询时间的设备
+adaptive_config = get_adaptive_config(config)
+if adaptive_config:
+    scheduler.add_job(func=collect_due_devices, trigger="interval", seconds=adaptive_config["check_seconds"],
+                      max_instances=1, coalesce=True)
 # 添加每天指定时间执行的数据清理任务
-scheduler.add_job(func=clean_old_data, trigger="cron", hour=cleanup_hour, minute=cleanup_minute)
+scheduler.add_job(func=submit_cleanup, trigger="cron", hour=cleanup_hour, minute=cleanup_minute,
+                  max_instances=1, coalesce=True)
 scheduler.start()
 
+# 上联端口识别为 flag 模式时，搜索结果默认隐藏标记为上联的记录
+trunk_config = get_trunk_config(config)
+TRUNK_FLAGGED = bool(trunk_config and trunk_config["mode"] == "flag")
+
+# 启动时加载 MAC 当前位置索引（没有快照时从数据库重建）
+location_index.ensure_loaded()
+
 @app.route("/")
 def index():
     return render_template("search.html")
@@ -65,48 +227,60 @@ def search():
     per_page = request.args.get('per_page', 50, type=int)
     sort_by = request.args.get('sort_by', 'timestamp')
     sort_order = request.args.get('sort_order', 'desc')
+    match = request.args.get('match', 'contains')
+    after = request.args.get('after', '')
+    before = request.args.get('before', '')
+    include_trunk = request.args.get('include_trunk', '') == '1'
     
-    # 标准化 MAC 地址格式（移除分隔符并转换为小写）
-    normalized_q = q.replace(':', '').replace('-', '').lower()
+    # 默认按时间降序
+    if sort_by not in SORT_COLUMNS:
+        sort_by = 'timestamp'
     
+    Model = get_mac_model()
     db = SessionLocal()
     try:
-        # 构建基础查询
-        if normalized_q:
-            query = db.query(MacEntry).filter(
-                func.replace(func.replace(MacEntry.mac, ':', ''), '-', '').ilike(f"%{normalized_q}%")
-            )
+        # 构建基础查询（按规范化的 mac_hex 列走索引）
+        if q.strip():
+            query = db.query(Model).filter(mac_search_filter(Model, q, match))
         else:
-            query = db.query(MacEntry)
-        
-        # 获取总记录数
-        total_count = query.count()
+            query = db.query(Model)
+        hide_trunk = TRUNK_FLAGGED and not include_trunk
+        if hide_trunk:
+            query = query.filter(Model.is_trunk.isnot(True))
         
-        # 应用排序
-        if sort_by in ['device', 'vlan', 'mac', 'port', 'timestamp']:
-            if sort_order == 'asc':
-                query = query.order_by(getattr(MacEntry, sort_by).asc())
-            else:
-                query = query.order_by(getattr(MacEntry, sort_by).desc())
-        else:
-            # 默认按时间降序
-            query = query.order_by(MacEntry.timestamp.desc())
+        # 获取总记录数（短时缓存，翻页不重复计数）
+        total_count = _cached_count(("search", STORAGE_MODE, q, match, hide_trunk), query)
         
         # 计算总页数
         total_pages = (total_count + per_page - 1) // per_page if total_count > 0 else 1
         
-        # 应用分页
-        results = query.offset((page - 1) * per_page).limit(per_page).all()
+        # 应用排序和游标分页
+        try:
+            results, prev_cursor, next_cursor = _keyset_page(
+                query, Model, SORT_COLUMNS[sort_by], sort_order != 'asc', per_page, after, before
+            )
+        except ValueError:
+            # 游标无效时回到第一页
+            page = 1
+            results, prev_cursor, next_cursor = _keyset_page(
+                query, Model, SORT_COLUMNS[sort_by], sort_order != 'asc', per_page
+            )
         
         return render_template("search.html", 
                               results=results, 
                               query=q,
+                              match=match,
                               page=page,
                               per_page=per_page,
                               total_pages=total_pages,
                               total_count=total_count,
+                              prev_cursor=prev_cursor,
+                              next_cursor=next_cursor,
                               sort_by=sort_by,
-                              sort_order=sort_order)
+                              sort_order=sort_order,
+                              trunk_flagged=TRUNK_FLAGGED,
+                              include_trunk=include_trunk,
+                              interval_mode=STORAGE_MODE == "interval")
     finally:
         db.close()
 
@@ -121,22 +295,30 @@ def by_date():
     per_page = request.args.get('per_page', 50, type=int)
     sort_by = request.args.get('sort_by', 'timestamp')
     sort_order = request.args.get('sort_order', 'desc')
+    after = request.args.get('after', '')
+    before = request.args.get('before', '')
+    
+    # 默认按时间降序
+    if sort_by not in SORT_COLUMNS:
+        sort_by = 'timestamp'
     
+    Model = get_mac_model()
+    interval_mode = Model is MacInterval
     db = SessionLocal()
     try:
-        # 获取所有有数据的日期
-        dates = db.query(
-            func.date(MacEntry.timestamp).label('collection_date')
-        ).distinct().order_by(func.date(MacEntry.timestamp).desc()).all()
-        
-        # 获取所有设备列表
-        devices = db.query(MacEntry.device).distinct().order_by(MacEntry.device).all()
-        devices = [d[0] for d in devices]
+        # 日期和设备下拉框直接读每日汇总表，不聚合 MAC 明细，结果缓存到下次采集或清理
+        dates = query_cache.get_or_compute(("by_date_dates",), lambda: [
+            d[0] for d in db.query(DailySummary.day).distinct().order_by(DailySummary.day.desc())
+        ])
+        devices = query_cache.get_or_compute(("by_date_devices",), lambda: [
+            d[0] for d in db.query(DailySummary.device).distinct().order_by(DailySummary.device)
+        ])
         
         results = []
         selected_date = None
         error_message = None
         total_count = 0
+        prev_cursor = next_cursor = None
         
         if date_str:
             try:
@@ -149,46 +331,38 @@ def by_date():
                 start_datetime = tz_shanghai.localize(start_datetime)
                 end_datetime = tz_shanghai.localize(end_datetime)
                 
-                # 构建基础查询
-                query = db.query(MacEntry).filter(
-                    MacEntry.timestamp >= start_datetime,
-                    MacEntry.timestamp <= end_datetime
-                )
-                
-                # 应用设备筛选
-                if device_filter:
-                    query = query.filter(MacEntry.device == device_filter)
-                
-                # 应用小时范围筛选
+                # 应用小时范围筛选：把当天的时间段收窄为 [start_hour:00, end_hour:59:59]，
+                # 仍是范围谓词，可以走 timestamp / device+timestamp 索引
                 if start_hour and end_hour:
                     try:
                         start_hour_int = int(start_hour)
                         end_hour_int = int(end_hour)
                         
                         if 0 <= start_hour_int <= 23 and 0 <= end_hour_int <= 23:
-                            # 添加小时筛选条件
-                            query = query.filter(
-                                func.extract('hour', MacEntry.timestamp) >= start_hour_int,
-                                func.extract('hour', MacEntry.timestamp) <= end_hour_int
-                            )
+                            start_datetime = start_datetime.replace(hour=start_hour_int)
+                            end_datetime = end_datetime.replace(hour=end_hour_int)
                     except ValueError:
                         error_message = "小时范围必须是0-23之间的整数"
+
+                # 构建基础查询并应用设备筛选
+                query = _by_date_query(db, Model, start_datetime, end_datetime, device_filter)
                 
-                # 获取总记录数
-                total_count = query.count()
-                
-                # 应用排序
-                if sort_by in ['device', 'vlan', 'mac', 'port', 'timestamp']:
-                    if sort_order == 'asc':
-                        query = query.order_by(getattr(MacEntry, sort_by).asc())
-                    else:
-                        query = query.order_by(getattr(MacEntry, sort_by).desc())
-                else:
-                    # 默认按时间降序
-                    query = query.order_by(MacEntry.timestamp.desc())
+                # 获取总记录数（短时缓存，翻页不重复计数）
+                total_count = _cached_count(
+                    ("by_date", STORAGE_MODE, start_datetime, end_datetime, device_filter), query
+                )
                 
-                # 应用分页
-                results = query.offset((page - 1) * per_page).limit(per_page).all()
+                # 应用排序和游标分页
+                try:
+                    results, prev_cursor, next_cursor = _keyset_page(
+                        query, Model, SORT_COLUMNS[sort_by], sort_order != 'asc', per_page, after, before
+                    )
+                except ValueError:
+                    # 游标无效时回到第一页
+                    page = 1
+                    results, prev_cursor, next_cursor = _keyset_page(
+                        query, Model, SORT_COLUMNS[sort_by], sort_order != 'asc', per_page
+                    )
                 
             except ValueError as e:
                 error_message = "日期格式错误，请使用 YYYY-MM-DD 格式"
@@ -197,7 +371,7 @@ def by_date():
         total_pages = (total_count + per_page - 1) // per_page if total_count > 0 else 1
         
         # 将日期对象转换为字符串，以便在模板中使用
-        date_strings = [d[0].strftime('%Y-%m-%d') if isinstance(d[0], datetime.date) else d[0] for d in dates]
+        date_strings = [d.strftime('%Y-%m-%d') for d in dates]
         selected_date_str = selected_date.strftime('%Y-%m-%d') if selected_date else None
         
         return render_template("by_date.html", 
@@ -212,9 +386,12 @@ def by_date():
                               per_page=per_page,
                               total_pages=total_pages,
                               total_count=total_count,
+                              prev_cursor=prev_cursor,
+                              next_cursor=next_cursor,
                               sort_by=sort_by,
                               sort_order=sort_order,
-                              error_message=error_message)
+                              error_message=error_message,
+                              interval_mode=interval_mode)
     except Exception as e:
         app.logger.error(f"按日期查看时发生错误: {e}")
         error_message = f"发生错误: {e}"
@@ -230,20 +407,17 @@ def by_date():
                               per_page=50,
                               total_pages=1,
                               total_count=0,
+                              prev_cursor=None,
+                              next_cursor=None,
                               sort_by='timestamp',
                               sort_order='desc',
-                              error_message=error_message)
+                              error_message=error_message,
+                              interval_mode=interval_mode)
     finally:
         db.close()
 def trigger():
     # 启动后台采集任务
-    task_id = str(datetime.datetime.now().timestamp())
-    collection_tasks[task_id] = {"status": "running", "message": "开始采集..."}
-    
-    # 在新线程中运行采集任务
-    thread = threading.Thread(target=run_collection_task, args=(task_id,))
-    thread.start()
-    
+    submit_collection()
     return redirect(url_for("logs"))
 
 @app.route("/manual_collect", methods=["POST"])
@@ -254,37 +428,139 @@ def manual_collect():
     if not network or not community:
         return jsonify({"error": "网络地址和community不能为空"}), 400
     
-    # 启动后台采集任务
-    task_id = str(datetime.datetime.now().timestamp())
-    collection_tasks[task_id] = {
-        "status": "running", 
-        "message": f"开始手动采集: {network}",
-        "network": network,
-        "community": community
-    }
-    
-    # 在新线程中运行采集任务
-    thread = threading.Thread(target=run_manual_collection_task, args=(task_id, network, community))
-    thread.start()
-    
+    # 启动后台采集任务，同一网段已有采集排队或进行中时返回那个任务
+    task_id = task_queue.submit("manual_collect", f"collect:{network.strip()}", run_manual_collection_task,
+                                network, community, message=f"开始手动采集: {network}")
     return jsonify({"success": True, "task_id": task_id})
 
 @app.route("/task_status/<task_id>")
 def task_status(task_id):
-    task = collection_tasks.get(task_id, {})
+    task = task_queue.status(task_id)
+    if task is None:
+        return jsonify({"status": "failed", "message": "任务不存在"}), 404
     return jsonify(task)
 
+# 进度推送的间隔和没有变化时发送心跳的间隔（秒）
+PROGRESS_INTERVAL = 1
+PROGRESS_HEARTBEAT = 15
+
+def _progress_event(task_id=None):
+    """当前采集进度；指定 task_id 时附带任务状态，任务不是正在运行的采集时不带进度"""
+    if not task_id:
+        return {"progress": sweep_progress.snapshot()}
+    task = task_queue.status(task_id)
+    if task is None:
+        return {"task": {"status": "failed", "message": "任务不存在"}}
+    event = {"task": task}
+    if task["status"] == "running" and task["kind"] in ("collect", "manual_collect"):
+        event["progress"] = sweep_progress.snapshot()
+    return event
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _observe_request(response):
+    """按路由模板（而不是实际 URL）记录请求耗时，避免标签数量无限增长"""
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - started, route, request.method, response.status_code)
+    return response
+
+def _sweep_gauge(field):
+    return lambda: {(): int(sweep_progress.snapshot()[field] or 0)}
+
+# 当前采集进度也作为指标输出，供监控面板使用
+for _name, _field, _doc in (
+    ("mactracker_sweep_running", "running", "是否有采集正在进行"),
+    ("mactracker_sweep_hosts_total", "hosts_total", "当前（或上一次）采集要轮询的设备数"),
+    ("mactracker_sweep_hosts_done", "hosts_done", "当前（或上一次）采集已完成的设备数"),
+    ("mactracker_sweep_macs", "macs", "当前（或上一次）采集发现的 MAC 数"),
+    ("mactracker_sweep_eta_seconds", "eta_seconds", "当前采集预计剩余秒数"),
+):
+    metrics.Gauge(_name, _doc, _sweep_gauge(_field))
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus 文本格式的运行指标，config.yaml 中 metrics.enabled 为 false 时返回 404"""
+    if not metrics.ENABLED:
+        abort(404)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# 一次批量查询最多的 MAC 数
+LOCATE_MAX_BATCH = (config.get("locations") or {}).get("max_batch", 10000)
+
+@app.route("/locate", methods=["GET", "POST"])
+def locate():
+    """查询 MAC 当前所在的设备和端口（内存索引，不查 mac_table）
+
+    GET /locate?mac=00:11:22:33:44:55（可重复或用逗号分隔）；
+    POST /locate，JSON 请求体 {"macs": [...]}，供 NAC 等系统批量查询。
+    """
+    if request.method == "POST":
+        body = request.get_json(silent=True)
+        macs = body.get("macs") if isinstance(body, dict) else body
+        if not isinstance(macs, list) or not all(isinstance(mac, str) for mac in macs):
+            return jsonify({"error": "请求体应为 {\"macs\": [\"00:11:22:33:44:55\", ...]}"}), 400
+    else:
+        macs = [mac.strip() for value in request.args.getlist("mac") for mac in value.split(",") if mac.strip()]
+    if not macs:
+        return jsonify({"error": "缺少 MAC 地址"}), 400
+    if len(macs) > LOCATE_MAX_BATCH:
+        return jsonify({"error": f"一次最多查询 {LOCATE_MAX_BATCH} 个 MAC"}), 400
+
+    results = location_index.lookup(macs)
+    found = sum(1 for value in results.values() if value is not None)
+    return jsonify({"results": results, "found": found, "missing": len(results) - found})
+
+@app.route("/progress")
+def progress():
+    """当前采集进度的 JSON 快照，供监控面板轮询"""
+    return jsonify(sweep_progress.snapshot())
+
+@app.route("/progress/stream")
+def progress_stream():
+    """用 server-sent events 推送采集进度
+
+    带 task_id 时推送该任务的状态和进度，任务结束后关闭连接；
+    不带时持续推送当前采集（包括定时采集）的进度。只在内容变化时推送，其余时间发送心跳。
+    """
+    task_id = request.args.get("task_id", "")
+
+    def generate():
+        last, idle = None, 0
+        while True:
+            event = _progress_event(task_id)
+            data = json.dumps(event, ensure_ascii=False)
+            if data != last:
+                yield f"data: {data}\n\n"
+                last, idle = data, 0
+            elif idle >= PROGRESS_HEARTBEAT:
+                yield ": heartbeat\n\n"
+                idle = 0
+            if task_id and event["task"]["status"] in ("completed", "failed"):
+                return
+            time.sleep(PROGRESS_INTERVAL)
+            idle += PROGRESS_INTERVAL
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/logs")
 def logs():
     """查看采集日志，支持分页和日期筛选"""
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 50, type=int)
     date_filter = request.args.get('date', '')
+    after = request.args.get('after', '')
+    before = request.args.get('before', '')
     
     db = SessionLocal()
     try:
         # 构建基础查询
-        query = db.query(LogEntry)
+        query = _logs_query(db)
         
         # 应用日期筛选
         if date_filter:
@@ -296,28 +572,28 @@ def logs():
                 end_datetime = tz_shanghai.localize(
                     datetime.datetime.combine(filter_date, datetime.time.max)
                 )
-                query = query.filter(
-                    LogEntry.timestamp >= start_datetime,
-                    LogEntry.timestamp <= end_datetime
-                )
+                query = _logs_query(db, start_datetime, end_datetime)
             except ValueError:
                 # 日期格式错误，忽略筛选
                 pass
         
-        # 获取总记录数
-        total_count = query.count()
+        # 获取总记录数（短时缓存，翻页不重复计数）
+        total_count = _cached_count(("logs", date_filter), query)
         
-        # 计算分页
-        logs = query.order_by(LogEntry.timestamp.desc()).offset((page - 1) * per_page).limit(per_page).all()
+        # 按时间倒序做游标分页
+        try:
+            logs, prev_cursor, next_cursor = _keyset_page(query, LogEntry, 'timestamp', True, per_page, after, before)
+        except ValueError:
+            page = 1
+            logs, prev_cursor, next_cursor = _keyset_page(query, LogEntry, 'timestamp', True, per_page)
         
         # 计算总页数
         total_pages = (total_count + per_page - 1) // per_page
         
-        # 获取所有有日志的日期
-        log_dates = db.query(
-            func.date(LogEntry.timestamp).label('log_date')
-        ).distinct().order_by(func.date(LogEntry.timestamp).desc()).all()
-        log_dates = [d[0].strftime('%Y-%m-%d') if isinstance(d[0], datetime.date) else d[0] for d in log_dates]
+        # 获取所有有日志的日期（沿 timestamp 索引逐日跳跃）
+        log_dates = query_cache.get_or_compute(("log_dates",), lambda: [
+            d.strftime('%Y-%m-%d') for d in distinct_dates(db, LogEntry.timestamp)
+        ])
         
         return render_template("logs.html", 
                               logs=logs, 
@@ -325,58 +601,163 @@ def logs():
                               per_page=per_page,
                               total_pages=total_pages,
                               total_count=total_count,
+                              prev_cursor=prev_cursor,
+                              next_cursor=next_cursor,
                               log_dates=log_dates,
                               selected_date=date_filter)
     finally:
         db.close()
 
 
+# 导出格式 -> MIME 类型
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+# 每次从数据库游标取出、拼成一块输出的行数
+EXPORT_CHUNK_ROWS = 1000
+
+def _parse_export_date(value, end=False):
+    """把 YYYY-MM-DD 转成当天起点（end=True 时为当天终点）的东八区时间，空值返回 None"""
+    if not value:
+        return None
+    day = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    return tz_shanghai.localize(datetime.datetime.combine(day, datetime.time.max if end else datetime.time.min))
+
+def iter_export(fmt="csv", start_date="", end_date="", device="", vlan="", since_id=0, max_id=None):
+    """按 id 顺序流式导出 MAC 记录，逐块生成 CSV 或 NDJSON 文本
+
+    只导出 since_id < id <= max_id 的行（max_id 为空时取导出开始时的最大 id），
+    下一次增量导出把 since_id 设为本次的 max_id 即可。数据库游标边读边输出，
+    内存占用与总行数无关。
+    """
+    Model = get_mac_model()
+    table = Model.__table__
+    columns = [col for col in table.c if col.name != "mac_hex"]
+    time_column = table.c.last_seen if Model is MacInterval else table.c.timestamp
+    start = _parse_export_date(start_date)
+    end = _parse_export_date(end_date, end=True)
+
+    db = SessionLocal()
+    try:
+        if max_id is None:
+            max_id = _mac_max_id(db, Model)
+        stmt = select(*columns).where(table.c.id > since_id, table.c.id <= max_id).order_by(table.c.id)
+        if start is not None:
+            stmt = stmt.where(time_column >= start)
+        if end is not None:
+            stmt = stmt.where(time_column <= end)
+        if device:
+            stmt = stmt.where(table.c.device == device)
+        if vlan:
+            stmt = stmt.where(table.c.vlan == vlan)
+
+        names = [col.name for col in columns]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == "csv":
+            writer.writerow(names)
+
+        result = db.execute(stmt.execution_options(yield_per=EXPORT_CHUNK_ROWS))
+        for partition in result.partitions():
+            for row in partition:
+                values = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in row]
+                if fmt == "csv":
+                    writer.writerow(values)
+                else:
+                    buffer.write(json.dumps(dict(zip(names, values)), ensure_ascii=False) + "\n")
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    finally:
+        db.close()
+
+def _mac_max_id(db, Model):
+    """MAC 记录的最大 id（分区时不扫描整个视图）"""
+    if Model is MacEntry:
+        return max_mac_entry_id(db)
+    return db.query(func.max(Model.id)).scalar() or 0
+
+def _export_max_id():
+    """导出开始时的最大 id，作为本次导出的上界"""
+    db = SessionLocal()
+    try:
+        return _mac_max_id(db, get_mac_model())
+    finally:
+        db.close()
+
+@app.route("/export")
+def export():
+    """流式导出 MAC 记录：?format=csv|ndjson&start=&end=&device=&vlan=&since_id=
+
+    响应头 X-Export-Max-Id 是本次导出的最大 id，增量导出时作为下一次的 since_id。
+    """
+    fmt = request.args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"不支持的导出格式: {fmt}"}), 400
+    try:
+        start_date = request.args.get("start", "")
+        end_date = request.args.get("end", "")
+        _parse_export_date(start_date)
+        _parse_export_date(end_date)
+    except ValueError:
+        return jsonify({"error": "日期格式错误，请使用 YYYY-MM-DD 格式"}), 400
+
+    since_id = request.args.get("since_id", 0, type=int)
+    max_id = _export_max_id()
+    rows = iter_export(fmt, start_date, end_date,
+                       request.args.get("device", ""), request.args.get("vlan", ""), since_id, max_id)
+    response = Response(stream_with_context(rows), mimetype=EXPORT_FORMATS[fmt])
+    response.headers["Content-Disposition"] = f"attachment; filename=mac_export_{since_id}_{max_id}.{fmt}"
+    response.headers["X-Export-Max-Id"] = str(max_id)
+    return response
+
 # 在 cleanup 路由中增加清除所有数据的功能
 @app.route("/cleanup", methods=["GET", "POST"])
 def cleanup():
-    """清理超过30天的数据或所有数据"""
+    """清理超过保留期的数据或所有数据"""
     if request.method == "POST":
         action = request.form.get("action")
         
         if action == "clean_old":
             # 启动后台清理任务
-            task_id = str(datetime.datetime.now().timestamp())
-            collection_tasks[task_id] = {"status": "running", "message": "开始清理旧数据..."}
-            
-            # 在新线程中运行清理任务
-            thread = threading.Thread(target=run_cleanup_task, args=(task_id,))
-            thread.start()
-            
+            task_id = submit_cleanup()
             return jsonify({"success": True, "task_id": task_id})
         
         elif action == "clean_all":
             # 启动后台清理所有数据任务
-            task_id = str(datetime.datetime.now().timestamp())
-            collection_tasks[task_id] = {"status": "running", "message": "开始清理所有数据..."}
-            
-            # 在新线程中运行清理所有数据任务
-            thread = threading.Thread(target=run_clean_all_task, args=(task_id,))
-            thread.start()
-            
+            task_id = task_queue.submit("clean_all", "cleanup:all", run_clean_all_task,
+                                        message="开始清理所有数据...")
             return jsonify({"success": True, "task_id": task_id})
     
-    # GET请求显示清理页面
+    # GET请求显示清理页面，统计结果缓存到下次采集或清理（保留期起点每天变化，放进缓存键）
+    cutoff = _retention_cutoff()
+    oldest_date, newest_date, total_count, old_count = query_cache.get_or_compute(
+        ("cleanup_stats", STORAGE_MODE, cutoff), lambda: _cleanup_stats(cutoff)
+    )
+    return render_template("cleanup.html", 
+                          oldest_date=oldest_date, 
+                          newest_date=newest_date,
+                          total_count=total_count,
+                          old_count=old_count,
+                          retention_days=RETENTION_DAYS)
+
+def _cleanup_stats(cutoff):
+    """清理页面的 (最早时间, 最晚时间, 总记录数, 可清理的记录数)"""
+    Model = get_mac_model()
     db = SessionLocal()
     try:
-        # 获取最早和最晚的数据日期
-        oldest_date = db.query(func.min(MacEntry.timestamp)).scalar()
-        newest_date = db.query(func.max(MacEntry.timestamp)).scalar()
-        total_count = db.query(MacEntry).count()
-        
-        # 计算30天前的日期
-        thirty_days_ago = datetime.datetime.now(tz_shanghai) - datetime.timedelta(days=30)
-        old_count = db.query(MacEntry).filter(MacEntry.timestamp < thirty_days_ago).count()
-        
-        return render_template("cleanup.html", 
-                              oldest_date=oldest_date, 
-                              newest_date=newest_date,
-                              total_count=total_count,
-                              old_count=old_count)
+        if Model is MacInterval:
+            # 获取最早和最晚的数据日期（timestamp 索引两端，无需扫描）
+            oldest_date = db.query(func.min(MacInterval.first_seen)).scalar()
+            newest_date = db.query(func.max(MacInterval.last_seen)).scalar()
+            # 区间可能跨越多天，按天汇总的行数会重复计算，区间表本身很小，直接计数
+            total_count = db.query(Model).count()
+            old_count = _old_data_query(db, Model, cutoff).count()
+        else:
+            oldest_date, newest_date = mac_time_range(db)
+            # 按整天（分区时按整个分区）清理，记录数直接从每日汇总表累加
+            total_count = _summary_row_count(db)
+            old_count = _summary_row_count(db, _retention_keep_from())
+        return oldest_date, newest_date, total_count, old_count
     finally:
         db.close()
 
@@ -385,9 +766,17 @@ def clean_all_data():
     """清理所有MAC地址数据，返回删除的记录数"""
     db = SessionLocal()
     try:
-        # 查询并删除所有数据
-        result = db.query(MacEntry).delete()
+        # 查询并删除所有数据（两种存储模式的表和每日汇总都清空，分区直接整表删除）
+        if PARTITIONED:
+            result = drop_all_partitions(db.connection())
+        else:
+            result = db.query(MacEntry).delete()
+        result += db.query(MacInterval).delete()
+        db.query(DailySummary).delete()
+        db.query(DailyMac).delete()
         db.commit()
+        location_index.clear()
+        location_index.save()
         
         # 添加日志记录
         db.add(LogEntry(message=f"清理了所有 {result} 条MAC地址数据"))
@@ -400,44 +789,113 @@ def clean_all_data():
         db.commit()
         raise e
     finally:
+        query_cache.bump()
         db.close()
 
-# 新增运行清理所有数据任务的函数
-def run_clean_all_task(task_id):
-    try:
-        deleted_count = clean_all_data()
-        collection_tasks[task_id]["status"] = "completed"
-        collection_tasks[task_id]["message"] = f"清理完成，删除了所有 {deleted_count} 条数据"
-    except Exception as e:
-        collection_tasks[task_id]["status"] = "failed"
-        collection_tasks[task_id]["message"] = f"清理所有数据失败: {str(e)}"
+# 后台任务的函数由任务队列调用，返回值作为任务完成时的消息，异常时任务标记为失败
+def run_clean_all_task():
+    deleted_count = clean_all_data()
+    return f"清理完成，删除了所有 {deleted_count} 条数据"
 
-def run_collection_task(task_id):
-    try:
-        collect_snmp()
-        collection_tasks[task_id]["status"] = "completed"
-        collection_tasks[task_id]["message"] = "采集完成"
-    except Exception as e:
-        collection_tasks[task_id]["status"] = "failed"
-        collection_tasks[task_id]["message"] = f"采集失败: {str(e)}"
+def run_collection_task():
+    collect_snmp()
+    return "采集完成"
+
+def run_manual_collection_task(network, community):
+    collect_snmp_manual(network, community)
+    return f"手动采集完成: {network}"
+
+def run_cleanup_task():
+    deleted_count = clean_old_data()
+    return f"清理完成，删除了 {deleted_count} 条旧数据"
 
-def run_manual_collection_task(task_id, network, community):
+@app.cli.command("check-plans")
+def check_plans():
+    """用 EXPLAIN QUERY PLAN 检查 /by_date、/logs 和清理用到的查询没有全表扫描
+
+    用法: flask --app app check-plans（仅 SQLite）。发现全表扫描时以非零状态退出。
+    """
+    from sqlalchemy import delete
+    if not IS_SQLITE:
+        raise click.ClickException("check-plans 只支持 SQLite；PostgreSQL 请用 EXPLAIN 检查")
+    Model = get_mac_model()
+    now = datetime.datetime.now(tz_shanghai)
+    day_start = now.replace(hour=8, minute=0, second=0, microsecond=0)
+    day_end = now.replace(hour=17, minute=59, second=59, microsecond=999999)
+    cutoff = now - datetime.timedelta(days=RETENTION_DAYS)
+
+    db = SessionLocal()
     try:
-        collect_snmp_manual(network, community)
-        collection_tasks[task_id]["status"] = "completed"
-        collection_tasks[task_id]["message"] = f"手动采集完成: {network}"
-    except Exception as e:
-        collection_tasks[task_id]["status"] = "failed"
-        collection_tasks[task_id]["message"] = f"手动采集失败: {str(e)}"
+        checks = {
+            "by_date": _by_date_query(db, Model, day_start, day_end)
+                .order_by(Model.timestamp.desc()).limit(50).statement,
+            "by_date (device)": _by_date_query(db, Model, day_start, day_end, "10.0.0.1")
+                .order_by(Model.timestamp.desc()).limit(50).statement,
+            "logs (date)": _logs_query(db, day_start, day_end)
+                .order_by(LogEntry.timestamp.desc()).limit(50).statement,
+            "logs dates": db.query(func.min(LogEntry.timestamp)).filter(LogEntry.timestamp >= day_start).statement,
+        }
+        if not PARTITIONED:
+            # 分区模式下清理是整表 DROP，不需要这两条查询
+            checks["cleanup count"] = _old_data_query(db, Model, cutoff).with_entities(func.count()).statement
+            checks["cleanup delete"] = delete(Model).where(Model.timestamp < cutoff)
+        failed = False
+        for name, statement in checks.items():
+            plan = explain_query_plan(db, statement)
+            scans = full_table_scans(plan)
+            failed = failed or bool(scans)
+            click.echo(f"{'FULL SCAN' if scans else 'ok':9} {name}: {'; '.join(plan)}")
+        if failed:
+            raise SystemExit(1)
+    finally:
+        db.close()
 
-def run_cleanup_task(task_id):
+@app.cli.command("export")
+@click.option("--format", "fmt", type=click.Choice(sorted(EXPORT_FORMATS)), default="csv", help="导出格式")
+@click.option("--start", "start_date", default="", help="开始日期 YYYY-MM-DD")
+@click.option("--end", "end_date", default="", help="结束日期 YYYY-MM-DD")
+@click.option("--device", default="", help="只导出指定设备")
+@click.option("--vlan", default="", help="只导出指定 VLAN")
+@click.option("--since-id", type=int, default=0, help="只导出 id 大于该值的记录")
+@click.option("--state-file", type=click.Path(), default=None,
+              help="增量导出状态文件：读取上次导出的最大 id 作为 --since-id，导出完成后写回")
+@click.option("--output", "-o", type=click.File("w", encoding="utf-8"), default="-", help="输出文件，默认标准输出")
+def export_command(fmt, start_date, end_date, device, vlan, since_id, state_file, output):
+    """流式导出 MAC 记录（与 /export 相同），用法: flask --app app export --format ndjson -o out.ndjson"""
+    if state_file:
+        try:
+            with open(state_file) as f:
+                since_id = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            pass
+    max_id = _export_max_id()
+    for chunk in iter_export(fmt, start_date, end_date, device, vlan, since_id, max_id):
+        output.write(chunk)
+    output.flush()
+    if state_file:
+        with open(state_file, "w") as f:
+            f.write(str(max_id))
+    click.echo(f"导出完成: id {since_id} < id <= {max_id}", err=True)
+
+def _parse_shard(ctx, param, value):
+    """解析 --shard i/n"""
+    if not value:
+        return None
     try:
-        deleted_count = clean_old_data()
-        collection_tasks[task_id]["status"] = "completed"
-        collection_tasks[task_id]["message"] = f"清理完成，删除了 {deleted_count} 条旧数据"
-    except Exception as e:
-        collection_tasks[task_id]["status"] = "failed"
-        collection_tasks[task_id]["message"] = f"清理失败: {str(e)}"
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("格式应为 i/n，例如 1/3")
+    if not 1 <= index <= count:
+        raise click.BadParameter("需要满足 1 <= i <= n")
+    return index, count
+
+@app.cli.command("collect")
+@click.option("--shard", callback=_parse_shard, default=None,
+              help="只采集第 i 个分片（共 n 个，按设备地址取模），多个节点各跑一个分片")
+def collect_command(shard):
+    """立即执行一次采集，用法: flask --app app collect --shard 1/3"""
+    collect_snmp(shard=shard)
 
 if __name__ == "__main__":
+    task_queue.interrupt_unfinished()
     app.run(host="0.0.0.0", port=8500)
\ No newline at end of file
@@ -0,0 +1,61 @@
+"""基准脚本共用的小工具：临时工作目录、延迟统计"""
+import os
+import statistics
+import tempfile
+import time
+
+import yaml
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def prepare_workdir(db_overrides=None, config_overrides=None, db_url=None):
+    """复制 config.yaml 到临时目录，数据库默认指向临时目录里的 SQLite 文件
+
+    返回临时目录路径；调用方 chdir 进去后再 import db / app，使用的就是这份配置。
+    """
+    workdir = tempfile.mkdtemp(prefix="mactracker-bench-")
+    with open(os.path.join(REPO_DIR, "config.yaml")) as f:
+        config = yaml.safe_load(f)
+    config["db"]["url"] = db_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    for key, value in (db_overrides or {}).items():
+        if isinstance(value, dict):
+            config["db"].setdefault(key, {}).update(value)
+        else:
+            config["db"][key] = value
+    for section, values in (config_overrides or {}).items():
+        config.setdefault(section, {}).update(values)
+    with open(os.path.join(workdir, "config.yaml"), "w") as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+    return workdir
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def latency_summary(latencies):
+    """秒为单位的延迟列表 -> 毫秒统计"""
+    if not latencies:
+        return {"requests": 0}
+    ms = [value * 1000 for value in latencies]
+    return {
+        "requests": len(ms),
+        "p50_ms": round(statistics.median(ms), 2),
+        "p95_ms": round(percentile(ms, 95), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "max_ms": round(max(ms), 2),
+    }
+
+
+def time_requests(client, url, repeat):
+    """用 Flask 测试客户端请求 url repeat 次，返回延迟统计；非 200 时抛出异常"""
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get(url)
+        latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} 返回 {response.status_code}")
+    return latency_summary(latencies)
@@ -0,0 +1,132 @@
+"""对模拟 SNMP 设备群跑采集的基准
+
+启动 snmp_fleet.py 模拟的设备群（独立进程，不和采集抢 GIL），在临时数据库上运行
+_perform_snmp_collection，按轮输出耗时、吞吐和各阶段耗时（来自 metrics），结果以 JSON 输出。
+第一轮包含存活探测，之后几轮只轮询已知设备。需要 root（模拟设备监听 161 端口）。
+
+用法（在仓库根目录）:
+    sudo python benchmarks/collect_fleet.py --devices 200 --macs 2000 --unresponsive 0.05 --runs 3
+    sudo python benchmarks/collect_fleet.py --processes 4 --storage-mode interval
+    sudo python benchmarks/collect_fleet.py --devices 2000 --backend async --max-in-flight 4000
+"""
+import argparse
+import ipaddress
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from bench_utils import REPO_DIR, prepare_workdir
+from snmp_fleet import add_fleet_arguments
+
+
+def _histogram_totals(histogram):
+    """{标签: (次数, 总和)}，标签为空的直方图直接用 ()"""
+    with histogram.lock:
+        return {labels: (state[2], state[1]) for labels, state in histogram.values.items()}
+
+
+def _delta(after, before):
+    result = {}
+    for labels, (count, total) in after.items():
+        prev_count, prev_total = before.get(labels, (0, 0.0))
+        result[labels] = (count - prev_count, total - prev_total)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_fleet_arguments(parser)
+    parser.add_argument("--runs", type=int, default=3, help="采集轮数")
+    parser.add_argument("--timeout", type=float, default=1, help="SNMP 超时（秒）")
+    parser.add_argument("--retries", type=int, default=0, help="SNMP 重试次数")
+    parser.add_argument("--max-workers", type=int, default=32, help="轮询线程数")
+    parser.add_argument("--processes", type=int, default=1, help="轮询进程数（snmp.shards.processes）")
+    parser.add_argument("--backend", default="easysnmp", choices=["easysnmp", "async"], help="snmp.backend")
+    parser.add_argument("--max-in-flight", type=int, default=2000, help="async 后端在途请求上限")
+    parser.add_argument("--max-hosts", type=int, default=1000, help="async 后端同时轮询的设备数")
+    parser.add_argument("--max-repetitions", type=int, default=25, help="GETBULK max_repetitions")
+    parser.add_argument("--storage-mode", default="history", choices=["history", "interval"])
+    parser.add_argument("--db-url", default=None, help="数据库 URL，默认临时目录里的 SQLite")
+    args = parser.parse_args()
+
+    fleet_args = [f"--{name.replace('_', '-')}={getattr(args, name)}" for name in
+                  ("devices", "macs", "vlans", "ports", "unresponsive", "delay_ms", "community", "base", "port", "seed")]
+    fleet = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), "snmp_fleet.py"), *fleet_args],
+                             stdout=subprocess.PIPE, text=True)
+    ready = fleet.stdout.readline()
+    if not ready:
+        sys.exit("模拟设备群启动失败")
+    fleet_info = json.loads(ready)
+
+    workdir = prepare_workdir({"storage_mode": args.storage_mode}, db_url=args.db_url)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    try:
+        import collector
+        import metrics
+
+        network = ipaddress.ip_network(fleet_info["network"])
+        bulk_config = {"max_repetitions": args.max_repetitions}
+        async_config = None
+        if args.backend == "async":
+            async_config = {**collector.DEFAULT_ASYNC, "max_in_flight": args.max_in_flight,
+                            "max_hosts": args.max_hosts}
+        histograms = {
+            "poll": metrics.POLL_SECONDS,
+            "poll_phase": metrics.POLL_PHASE_SECONDS,
+            "db_write": metrics.DB_WRITE_SECONDS,
+            "db_commit": metrics.DB_COMMIT_SECONDS,
+        }
+        runs = []
+        for run in range(args.runs):
+            before = {name: _histogram_totals(h) for name, h in histograms.items()}
+            started = time.perf_counter()
+            collector._perform_snmp_collection(
+                network, args.community, args.timeout, args.retries, args.max_workers,
+                probe_timeout=args.timeout, full_sweep=run == 0, bulk_config=bulk_config,
+                processes=args.processes, async_config=async_config,
+            )
+            elapsed = time.perf_counter() - started
+            progress = collector.sweep_progress.snapshot()
+            phases = {}
+            for name, histogram in histograms.items():
+                for labels, (count, total) in _delta(_histogram_totals(histogram), before[name]).items():
+                    key = name + "".join(f".{label}" for label in labels)
+                    phases[key] = {"count": count, "total_seconds": round(total, 3),
+                                   "mean_ms": round(total / count * 1000, 2) if count else None}
+            runs.append({
+                "run": run + 1,
+                "discovery": run == 0,
+                "seconds": round(elapsed, 2),
+                "hosts_polled": progress["hosts_total"],
+                "hosts_failed": progress["hosts_failed"],
+                "macs": progress["macs"],
+                "snmp_requests": progress["requests"],
+                "macs_per_second": round(progress["macs"] / elapsed),
+                "requests_per_second": round(progress["requests"] / elapsed),
+                "phases": phases,
+            })
+    finally:
+        fleet.terminate()
+        fleet.wait()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps({
+        "benchmark": "collect_fleet",
+        "fleet": {**fleet_info, "macs_per_device": args.macs, "vlans": args.vlans, "ports": args.ports,
+                  "delay_ms": args.delay_ms},
+        "storage_mode": args.storage_mode,
+        "max_workers": args.max_workers,
+        "processes": args.processes,
+        "backend": args.backend,
+        "max_repetitions": args.max_repetitions,
+        "runs": runs,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""在合成的大数据量 mac_table 上测量查询和清理耗时
+
+生成 --rows 条（1M～50M）MAC 记录：--devices 台设备，每台每次采集 --macs 条，
+采集时间均匀分布在最近 --days 天里，同时写入对应的采集日志和每日汇总。然后用
+Flask 测试客户端计时 /search（前缀、子串）、/by_date（全部设备、单台设备、按 MAC 排序）、
+/logs（首页、按日期），最后计时一次 clean_old_data（会删除超过保留期的数据）。结果以 JSON 输出。
+
+用法（在仓库根目录）:
+    python benchmarks/query_dataset.py --rows 1000000
+    python benchmarks/query_dataset.py --rows 10000000 --partition day --keep   # 保留数据库目录
+    python benchmarks/query_dataset.py --workdir /tmp/mactracker-bench-xxxx     # 复用已生成的数据
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import shutil
+import sys
+import time
+
+from bench_utils import REPO_DIR, prepare_workdir, time_requests
+
+# 每次提交的行数
+LOAD_CHUNK = 200000
+
+
+def _load(db, args):
+    """按采集时间顺序写入合成数据，返回 (写入行数, 秒)"""
+    from sqlalchemy import insert
+    now = db.get_shanghai_time().replace(minute=0, second=0, microsecond=0)
+    polls = max(1, math.ceil(args.rows / (args.devices * args.macs)))
+    step = datetime.timedelta(days=args.days) / max(1, polls - 1)
+    session = db.SessionLocal()
+    written = 0
+    started = time.perf_counter()
+    try:
+        pending = 0
+        for poll in range(polls):
+            timestamp = now - step * (polls - 1 - poll)
+            logs = []
+            for device in range(args.devices):
+                if written >= args.rows:
+                    break
+                count = min(args.macs, args.rows - written)
+                host = f"10.{device >> 16 & 255}.{device >> 8 & 255}.{device & 255}"
+                db.bulk_insert_mac_entries(session, [
+                    (host, f"VLAN{i % args.vlans:04d}",
+                     f"00:11:{device >> 8 & 255:02x}:{device & 255:02x}:{i >> 8 & 255:02x}:{i & 255:02x}",
+                     str(i % 48 + 1), timestamp)
+                    for i in range(count)
+                ])
+                logs.append({"message": f"SNMP扫描成功: {host}, 发现 {count} 个MAC地址", "timestamp": timestamp})
+                written += count
+                pending += count
+            session.execute(insert(db.LogEntry), logs)
+            if pending >= LOAD_CHUNK:
+                session.commit()
+                pending = 0
+        session.commit()
+        # 每日汇总表由采集增量维护，这里按天一次性汇总
+        with db.engine.begin() as conn:
+            db._backfill_daily_summary(conn)
+    finally:
+        session.close()
+    return written, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000, help="合成的 MAC 记录数")
+    parser.add_argument("--devices", type=int, default=200, help="设备数")
+    parser.add_argument("--macs", type=int, default=500, help="每台设备每次采集的 MAC 数（最多 65536）")
+    parser.add_argument("--vlans", type=int, default=16, help="VLAN 数")
+    parser.add_argument("--days", type=int, default=35, help="数据覆盖的天数（超过保留期的部分会被清理）")
+    parser.add_argument("--repeat", type=int, default=20, help="每个请求的重复次数")
+    parser.add_argument("--partition", default="none", choices=["none", "day", "week"], help="db.partition")
+    parser.add_argument("--db-url", default=None, help="数据库 URL，默认临时目录里的 SQLite")
+    parser.add_argument("--workdir", default=None, help="复用之前 --keep 保留的目录，跳过生成数据")
+    parser.add_argument("--keep", action="store_true", help="结束后保留临时目录（不运行清理）")
+    args = parser.parse_args()
+
+    workdir = args.workdir or prepare_workdir({"storage_mode": "history", "partition": args.partition},
+                                              config_overrides={"metrics": {"enabled": False}}, db_url=args.db_url)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    result = {"benchmark": "query_dataset", "workdir": workdir}
+    try:
+        import db
+        import app as webapp
+        webapp.app.root_path = REPO_DIR
+        webapp.scheduler.shutdown(wait=False)
+
+        if args.workdir:
+            result["load"] = None
+        else:
+            written, seconds = _load(db, args)
+            result["load"] = {"rows": written, "seconds": round(seconds, 1), "rows_per_second": round(written / seconds)}
+
+        session = db.SessionLocal()
+        try:
+            total = webapp._summary_row_count(session)
+            days = [day for (day,) in session.query(db.DailySummary.day).distinct().order_by(db.DailySummary.day)]
+        finally:
+            session.close()
+        middle_day = days[len(days) // 2] if days else datetime.date.today().isoformat()
+        result.update({"rows": total, "partition": db.PARTITION, "dialect": db.engine.dialect.name})
+
+        client = webapp.app.test_client()
+        # /by_date 和 /logs 会缓存总数，重复请求测的是翻页时的实际开销，首次请求单独列出
+        queries = {
+            "search_prefix": "/search?q=00:11:00:0a&match=prefix",
+            "search_contains": "/search?q=0a:01&match=contains",
+            "by_date_all": f"/by_date?date={middle_day}",
+            "by_date_device": f"/by_date?date={middle_day}&device=10.0.0.10",
+            "by_date_sort_mac": f"/by_date?date={middle_day}&sort_by=mac&sort_order=asc",
+            "logs": "/logs",
+            "logs_date": f"/logs?date={middle_day}",
+        }
+        timings = {}
+        for name, url in queries.items():
+            timings[name] = {"first_ms": time_requests(client, url, 1)["max_ms"], **time_requests(client, url, args.repeat)}
+        result["queries"] = timings
+
+        if not args.keep:
+            started = time.perf_counter()
+            deleted = webapp.clean_old_data()
+            result["clean_old_data"] = {"deleted": deleted, "seconds": round(time.perf_counter() - started, 2),
+                                        "retention_days": db.RETENTION_DAYS}
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""采集写入期间 /search 的响应延迟基准
+
+在临时目录里建一个独立的数据库（不碰 data/ 下的正式库），一个线程模拟采集：
+逐台设备批量写入 MAC 记录、更新每日汇总并提交；同时若干线程不断请求 /search，
+统计请求延迟，结果以 JSON 输出。
+
+用法（在仓库根目录）:
+    python benchmarks/search_during_sweep.py --devices 200 --macs 2000 --readers 4
+    python benchmarks/search_during_sweep.py --journal-mode delete   # 对比回滚日志模式
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+
+from bench_utils import REPO_DIR, latency_summary, prepare_workdir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=200, help="模拟采集的设备数")
+    parser.add_argument("--macs", type=int, default=2000, help="每台设备的 MAC 数")
+    parser.add_argument("--readers", type=int, default=4, help="并发请求 /search 的线程数")
+    parser.add_argument("--journal-mode", default="wal", help="SQLite journal_mode（wal / delete）")
+    args = parser.parse_args()
+
+    workdir = prepare_workdir({"storage_mode": "history", "sqlite": {"journal_mode": args.journal_mode}})
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import db
+    import app as webapp
+    webapp.app.root_path = REPO_DIR
+
+    def sweep(latencies):
+        """与 _perform_snmp_collection 的写入方式相同：每台设备一个事务"""
+        session = db.SessionLocal()
+        try:
+            for device in range(args.devices):
+                started = time.perf_counter()
+                host = f"10.{device // 65536}.{device // 256 % 256}.{device % 256}"
+                now = db.get_shanghai_time()
+                rows = [
+                    (host, f"vlan{i % 8}", ":".join(f"{b:02x}" for b in (0, 17, device % 256, i >> 16, (i >> 8) & 255, i & 255)),
+                     str(i % 48 + 1), now)
+                    for i in range(args.macs)
+                ]
+                db.bulk_insert_mac_entries(session, rows)
+                db.refresh_daily_summary(session, host, now, [mac for _, _, mac, _, _ in rows], len(rows))
+                session.commit()
+                latencies.append(time.perf_counter() - started)
+        finally:
+            session.close()
+
+    def reader(stop, latencies):
+        client = webapp.app.test_client()
+        while not stop.is_set():
+            q = f"00:11:{random.randrange(args.devices) % 256:02x}"
+            started = time.perf_counter()
+            response = client.get(f"/search?q={q}&match=prefix")
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200
+
+    stop = threading.Event()
+    commit_latencies = []
+    search_latencies = [[] for _ in range(args.readers)]
+    readers = [threading.Thread(target=reader, args=(stop, search_latencies[i])) for i in range(args.readers)]
+    try:
+        with db.engine.connect() as conn:
+            journal_mode = conn.exec_driver_sql("PRAGMA journal_mode").scalar()
+        started = time.perf_counter()
+        for thread in readers:
+            thread.start()
+        sweep(commit_latencies)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        for thread in readers:
+            thread.join()
+    finally:
+        stop.set()
+        webapp.scheduler.shutdown(wait=False)
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps({
+        "benchmark": "search_during_sweep",
+        "journal_mode": journal_mode,
+        "devices": args.devices,
+        "macs_per_device": args.macs,
+        "readers": args.readers,
+        "sweep_seconds": round(elapsed, 2),
+        "rows_per_second": round(args.devices * args.macs / elapsed),
+        "device_commit": latency_summary(commit_latencies),
+        "search": latency_summary([value for values in search_latencies for value in values]),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""模拟一批 SNMP v2c 交换机，供采集基准使用
+
+每台模拟设备监听 127.x.y.z:161 的一个地址（Linux 上整个 127.0.0.0/8 都落在回环口，
+不需要额外配置），应答 GET / GETNEXT / GETBULK，内容是采集用到的几张表：
+sysObjectID、sysUpTime、dot1qFdbDynamicCount、dot1qVlanStaticName、dot1qPvid 和
+dot1dTpFdbPort。转发表按需计算，不在内存里展开，单进程可以模拟几百台、每台上万条 MAC。
+一部分设备（--unresponsive）收到请求后不应答，用来模拟超时。
+
+绑定 161 端口需要 root（或 CAP_NET_BIND_SERVICE）。单独运行:
+    sudo python benchmarks/snmp_fleet.py --devices 200 --macs 2000
+就绪后打印一行 JSON（网段、设备数等），之后一直运行到收到 SIGINT / SIGTERM。
+"""
+import argparse
+import asyncio
+import bisect
+import ipaddress
+import json
+import random
+import signal
+import sys
+import time
+
+from bench_utils import REPO_DIR
+
+sys.path.insert(0, REPO_DIR)
+from snmp_async import (INTEGER, OCTET_STRING, OBJECT_ID, SEQUENCE, COUNTER32, GAUGE32, TIMETICKS,  # noqa: E402
+                        NO_SUCH_INSTANCE, END_OF_MIB_VIEW, GET, GETNEXT, RESPONSE, GETBULK,
+                        encode_tlv, encode_integer, encode_oid, encode_value, decode_tlv, decode_integer, decode_oid)
+
+SYS_OBJECT_ID = (1, 3, 6, 1, 2, 1, 1, 2, 0)
+SYS_UPTIME = (1, 3, 6, 1, 2, 1, 1, 3, 0)
+FDB_PORT = (1, 3, 6, 1, 2, 1, 17, 4, 3, 1, 2)
+FDB_DYNAMIC_COUNT = (1, 3, 6, 1, 2, 1, 17, 7, 1, 2, 1, 1, 2)
+VLAN_NAME = (1, 3, 6, 1, 2, 1, 17, 7, 1, 4, 3, 1, 1)
+PVID = (1, 3, 6, 1, 2, 1, 17, 7, 1, 4, 5, 1, 1)
+
+STARTED = time.monotonic()
+
+
+# ---- 请求/应答报文（BER 基本编解码与采集器的异步引擎共用 snmp_async） ----
+
+def _decode_request(data):
+    """解析 v2c 请求，返回 (community, pdu 类型, request_id, non_repeaters, max_repetitions, [oid, ...])"""
+    _, message, _ = decode_tlv(data, 0)
+    _, version, offset = decode_tlv(message, 0)
+    _, community, offset = decode_tlv(message, offset)
+    pdu_type, pdu, _ = decode_tlv(message, offset)
+    _, request_id, offset = decode_tlv(pdu, 0)
+    _, first, offset = decode_tlv(pdu, offset)
+    _, second, offset = decode_tlv(pdu, offset)
+    _, bindings, _ = decode_tlv(pdu, offset)
+    oids = []
+    offset = 0
+    while offset < len(bindings):
+        _, binding, offset = decode_tlv(bindings, offset)
+        _, oid, _ = decode_tlv(binding, 0)
+        oids.append(decode_oid(oid))
+    return community, pdu_type, decode_integer(request_id), decode_integer(first), decode_integer(second), oids
+
+
+def _encode_response(community, request_id, bindings):
+    varbinds = b"".join(encode_tlv(SEQUENCE, encode_oid(oid) + encode_value(tag, value))
+                        for oid, tag, value in bindings)
+    pdu = encode_tlv(RESPONSE, encode_integer(INTEGER, request_id) + encode_integer(INTEGER, 0)
+                     + encode_integer(INTEGER, 0) + encode_tlv(SEQUENCE, varbinds))
+    return encode_tlv(SEQUENCE, encode_integer(INTEGER, 1) + encode_tlv(OCTET_STRING, community) + pdu)
+
+
+# ---- 模拟设备的 MIB ----
+
+class _Table:
+    """MIB 中一段按 OID 排好序的表：oids 可以是任何支持下标和 len 的序列，value(i) 返回 (标签, 值)"""
+
+    def __init__(self, oids, value):
+        self.oids = oids
+        self.value = value
+
+
+class _FdbOids:
+    """按需计算的转发表 OID 序列：第 i 条的 MAC 是 00:11:设备号高:设备号低:i高:i低"""
+
+    def __init__(self, device, count):
+        self.prefix = FDB_PORT + (0, 0x11, device >> 8 & 0xFF, device & 0xFF)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.prefix + (index >> 8 & 0xFF, index & 0xFF)
+
+
+class Agent:
+    def __init__(self, device, macs, vlans, ports):
+        vlan_ids = list(range(1, vlans + 1))
+        pvids = [vlan_ids[port % vlans] for port in range(1, ports + 1)]
+        self.tables = [
+            _Table([SYS_OBJECT_ID], lambda i: (OBJECT_ID, (1, 3, 6, 1, 4, 1, 9, 1, 1))),
+            _Table([SYS_UPTIME], lambda i: (TIMETICKS, int((time.monotonic() - STARTED) * 100))),
+            _Table(_FdbOids(device, macs), lambda i: (INTEGER, i % ports + 1)),
+            _Table([FDB_DYNAMIC_COUNT + (1,)], lambda i: (COUNTER32, macs)),
+            _Table([VLAN_NAME + (vid,) for vid in vlan_ids], lambda i: (OCTET_STRING, f"VLAN{vlan_ids[i]:04d}")),
+            _Table([PVID + (port,) for port in range(1, ports + 1)], lambda i: (GAUGE32, pvids[i])),
+        ]
+
+    def get(self, oid):
+        for table in self.tables:
+            index = bisect.bisect_left(table.oids, oid)
+            if index < len(table.oids) and table.oids[index] == oid:
+                return (oid, *table.value(index))
+        return oid, NO_SUCH_INSTANCE, None
+
+    def get_next(self, oid):
+        for table in self.tables:
+            index = bisect.bisect_right(table.oids, oid)
+            if index < len(table.oids):
+                return (table.oids[index], *table.value(index))
+        return oid, END_OF_MIB_VIEW, None
+
+    def get_bulk(self, oids, non_repeaters, max_repetitions):
+        bindings = [self.get_next(oid) for oid in oids[:non_repeaters]]
+        for oid in oids[non_repeaters:]:
+            for _ in range(max(0, max_repetitions)):
+                binding = self.get_next(oid)
+                bindings.append(binding)
+                if binding[1] == END_OF_MIB_VIEW:
+                    break
+                oid = binding[0]
+        return bindings
+
+
+class _AgentProtocol(asyncio.DatagramProtocol):
+    def __init__(self, agent, community, delay, responsive):
+        self.agent = agent
+        self.community = community
+        self.delay = delay
+        self.responsive = responsive
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if not self.responsive:
+            return
+        try:
+            community, pdu_type, request_id, first, second, oids = _decode_request(data)
+        except (IndexError, ValueError):
+            return
+        if community != self.community:
+            return
+        if pdu_type == GET:
+            bindings = [self.agent.get(oid) for oid in oids]
+        elif pdu_type == GETNEXT:
+            bindings = [self.agent.get_next(oid) for oid in oids]
+        elif pdu_type == GETBULK:
+            bindings = self.agent.get_bulk(oids, first, second)
+        else:
+            return
+        response = _encode_response(community, request_id, bindings)
+        if self.delay:
+            asyncio.get_running_loop().call_later(self.delay, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+
+def fleet_network(base, devices):
+    """能容纳 devices 台设备的最小网段（从 base 开始）"""
+    prefix = 32
+    while ipaddress.ip_network(f"{base}/{prefix}", strict=False).num_addresses - 2 < devices:
+        prefix -= 1
+    return ipaddress.ip_network(f"{base}/{prefix}", strict=False)
+
+
+async def serve(args):
+    network = fleet_network(args.base, args.devices)
+    rng = random.Random(args.seed)
+    hosts = list(network.hosts())[:args.devices]
+    silent = set(rng.sample(range(len(hosts)), int(len(hosts) * args.unresponsive)))
+    loop = asyncio.get_running_loop()
+    transports = []
+    for device, host in enumerate(hosts):
+        agent = Agent(device, args.macs, args.vlans, args.ports)
+        protocol = _AgentProtocol(agent, args.community.encode(), args.delay_ms / 1000, device not in silent)
+        transport, _ = await loop.create_datagram_endpoint(lambda p=protocol: p, local_addr=(str(host), args.port))
+        transports.append(transport)
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    print(json.dumps({"ready": True, "network": str(network), "devices": len(hosts),
+                      "unresponsive": len(silent), "port": args.port}), flush=True)
+    await stop.wait()
+    for transport in transports:
+        transport.close()
+
+
+def add_fleet_arguments(parser):
+    parser.add_argument("--devices", type=int, default=200, help="模拟设备数")
+    parser.add_argument("--macs", type=int, default=2000, help="每台设备转发表的 MAC 数（最多 65536）")
+    parser.add_argument("--vlans", type=int, default=16, help="每台设备的 VLAN 数")
+    parser.add_argument("--ports", type=int, default=48, help="每台设备的端口数")
+    parser.add_argument("--unresponsive", type=float, default=0.0, help="不应答的设备占比（模拟超时）")
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="每个应答的附加延迟（毫秒）")
+    parser.add_argument("--community", default="public")
+    parser.add_argument("--base", default="127.1.0.0", help="模拟设备网段的起始地址（须在 127.0.0.0/8 内）")
+    parser.add_argument("--port", type=int, default=161, help="监听端口；采集器固定使用 161")
+    parser.add_argument("--seed", type=int, default=1, help="挑选不应答设备的随机种子")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_fleet_arguments(parser)
+    args = parser.parse_args()
+    if args.macs > 65536:
+        parser.error("--macs 最多 65536")
+    try:
+        asyncio.run(serve(args))
+    except PermissionError:
+        sys.exit(f"无法绑定端口 {args.port}，请用 root 运行或授予 CAP_NET_BIND_SERVICE")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+import yaml
+import metrics
+
+# 网页查询结果缓存：日期/设备列表、总数、最早最晚时间这类聚合只在采集或清理提交后才会变化。
+# 每条缓存记下写入时的“数据代数”，采集每提交一台设备、清理每完成一次就把代数加一，
+# 旧代数的缓存即失效；ttl_seconds 只是兜底（例如另一个进程用 flask collect 采集、又没有共享后端时）。
+
+with open("config.yaml") as f:
+    config = yaml.safe_load(f)
+
+DEFAULT_CACHE = {
+    "enabled": True,
+    "backend": "local",  # local | redis
+    "max_entries": 2000,
+    "ttl_seconds": 300,
+    "url": "redis://localhost:6379/0",
+    "prefix": "mactracker:",
+}
+
+GENERATION_KEY = "generation"
+
+class LocalBackend:
+    """进程内的 LRU 后端，超过 max_entries 时淘汰最久未使用的条目
+
+    接口与 RedisBackend 相同（get / set / incr / counter），也可以在测试或单机部署时代替共享后端。
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE["max_entries"]):
+        self.max_entries = max(1, max_entries)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {key: (过期时间, 值)}
+        self.counters = {}
+
+    def get(self, key):
+        """返回 (是否命中, 值)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, entry[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def counter(self, key):
+        with self.lock:
+            return self.counters.get(key, 0)
+
+class RedisBackend:
+    """多个 Web 进程/节点共享的 Redis 后端（需要安装 redis 包）
+
+    值用 pickle 序列化；容量和淘汰交给 Redis 的 maxmemory-policy（建议 allkeys-lru）。
+    """
+
+    def __init__(self, url, prefix=DEFAULT_CACHE["prefix"]):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return False, None
+        return True, pickle.loads(raw)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=max(1, int(ttl)))
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def counter(self, key):
+        return int(self.client.get(self.prefix + key) or 0)
+
+class QueryCache:
+    """按数据代数失效的查询结果缓存"""
+
+    def __init__(self, backend, ttl=DEFAULT_CACHE["ttl_seconds"], enabled=True):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+
+    def generation(self):
+        return self.backend.counter(GENERATION_KEY)
+
+    def bump(self):
+        """数据已变化（采集或清理提交之后调用），之前缓存的结果全部作废"""
+        return self.backend.incr(GENERATION_KEY)
+
+    def get_or_compute(self, key, compute):
+        """key 为可 repr 的元组，第一个元素用作指标标签；未命中时调用 compute() 并缓存结果"""
+        if not self.enabled:
+            return compute()
+        generation = self.generation()
+        cache_key = f"q:{key!r}"
+        hit, entry = self.backend.get(cache_key)
+        if hit and entry[0] == generation:
+            metrics.CACHE_REQUESTS.inc(key[0], "hit")
+            return entry[1]
+        metrics.CACHE_REQUESTS.inc(key[0], "miss")
+        value = compute()
+        self.backend.set(cache_key, (generation, value), self.ttl)
+        return value
+
+def _make_cache(config):
+    settings = {**DEFAULT_CACHE, **(config.get("cache") or {})}
+    if settings["backend"] == "redis":
+        backend = RedisBackend(settings["url"], settings["prefix"])
+    else:
+        backend = LocalBackend(settings["max_entries"])
+    return QueryCache(backend, settings["ttl_seconds"], bool(settings["enabled"]))
+
+query_cache = _make_cache(config)
@@ -1,16 +1,207 @@
+import asyncio
+import contextlib
 import ipaddress
 import datetime
+import multiprocessing
+import os
+import queue
+import threading
+import time
 import yaml
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from easysnmp import Session
-from db import SessionLocal, MacEntry, LogEntry
+import metrics
+import snmp_async
+from locations import location_index
+from cache import query_cache
+from db import (SessionLocal, LogEntry, KnownAgent, STORAGE_MODE, get_shanghai_time,
+                bulk_insert_mac_entries, record_mac_intervals, refresh_daily_summary,
+                extend_mac_intervals, previous_bindings)
 
 # OID 定义
 OID_MAC_TABLE = "1.3.6.1.2.1.17.4.3.1.2"  # dot1dTpFdbPort (传统网桥MIB)
 OID_VLAN_NAME = "1.3.6.1.2.1.17.7.1.4.3.1.1"  # dot1qVlanStaticName
 OID_DOT1Q_VLAN = "1.3.6.1.2.1.17.7.1.4.5.1.1"  # dot1qPvid (标准 802.1Q PVID)
+OID_SYS_OBJECT_ID = "1.3.6.1.2.1.1.2.0"  # sysObjectID
+OID_SYS_UPTIME = "1.3.6.1.2.1.1.3.0"  # sysUpTime
+OID_FDB_DYNAMIC_COUNT = "1.3.6.1.2.1.17.7.1.2.1.1.2"  # dot1qFdbDynamicCount（每个转发数据库的动态表项数）
+OID_BASE_PORT_IFINDEX = "1.3.6.1.2.1.17.1.4.1.2"  # dot1dBasePortIfIndex（网桥端口号 -> ifIndex）
+OID_LLDP_REM_CHASSIS = "1.0.8802.1.1.2.1.4.1.1.5"  # lldpRemChassisId（索引为 timeMark.localPortNum.remIndex）
 
-def collect_snmp():
-    """使用配置文件中的设置进行采集"""
+# 并发轮询的默认线程数
+DEFAULT_MAX_WORKERS = 32
+
+# GETBULK 每个请求返回的最大行数
+DEFAULT_MAX_REPETITIONS = 25
+
+# 存活探测的默认设置：超时（秒）、并发数、每隔多少次定时采集重新扫描整个网段
+DEFAULT_PROBE_TIMEOUT = 1
+DEFAULT_PROBE_WORKERS = 128
+DEFAULT_FULL_SWEEP_EVERY = 6
+
+# 自适应轮询的默认设置：间隔上下限（分钟）、判定为繁忙的绑定变化占比、最多连续跳过完整遍历的次数
+DEFAULT_ADAPTIVE = {
+    "enabled": False,
+    "min_minutes": 10,
+    "max_minutes": 240,
+    "check_seconds": 60,
+    "busy_churn": 0.02,
+    "skip_unchanged": True,
+    "max_skips": 3,
+    "expire_days": 7,
+}
+
+# 上联/Trunk 端口识别的默认设置：mode 为 off（不识别）、flag（写入并标记）或 drop（不写入）；
+# 学习到的 MAC 超过 max_macs 个的端口判定为上联，lldp 为 True 时有 LLDP 邻居的端口也算
+DEFAULT_TRUNK = {
+    "mode": "off",
+    "max_macs": 20,
+    "lldp": False,
+}
+
+# SNMP 后端：easysnmp（默认，每台在途设备占一个线程）或 async（asyncio 引擎，所有请求共用一个 UDP 套接字）。
+# async 的默认设置：所有设备合计的在途请求上限、同时轮询的设备数、每台设备的在途请求数和相邻请求的最小间隔
+DEFAULT_ASYNC = {
+    "max_in_flight": 2000,
+    "max_hosts": 1000,
+    "per_host": 1,
+    "min_interval_ms": 0,
+}
+
+# 定时采集次数计数，用于决定本次是否重新扫描整个网段
+_scheduled_runs = 0
+
+# 同一时间只进行一次采集或清理，到期设备轮询遇到正在进行的任务时直接跳过；
+# 任务队列的线程会先持有它再调用 collect_snmp，所以是可重入锁
+collection_lock = threading.RLock()
+
+# 单台设备的轮询结果；rows 为 None 表示转发表没有变化、跳过了完整遍历；phases 为各阶段耗时 {阶段: 秒}；
+# trunk_ports 为判定为上联的端口号集合（未启用识别时为空）
+PollResult = namedtuple("PollResult", ["messages", "rows", "requests", "fingerprint", "seconds", "phases",
+                                       "trunk_ports"])
+
+class SweepProgress:
+    """当前采集的进度计数，采集线程更新，网页和监控接口读取快照
+
+    采集由 collection_lock 串行执行，同一时间只有一次采集，所以全局一份即可。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sweeps = 0  # 已开始的采集次数，用来区分前后两次采集
+        self._reset(phase="idle")
+
+    def _reset(self, phase, network=None):
+        self.phase = phase  # idle | discovery | polling
+        self.network = network
+        self.started = None
+        self.ended = None
+        self.hosts_total = 0
+        self.hosts_done = 0
+        self.hosts_failed = 0
+        self.current_host = None
+        self.macs = 0
+        self.requests = 0
+
+    def begin(self, network):
+        with self.lock:
+            self._reset(phase="discovery", network=str(network))
+            self.sweeps += 1
+            self.started = time.monotonic()
+
+    def polling(self, total):
+        with self.lock:
+            self.phase = "polling"
+            self.hosts_total = total
+
+    def host_done(self, host_str, macs, requests, failed=False):
+        with self.lock:
+            self.hosts_done += 1
+            self.hosts_failed += failed
+            self.current_host = host_str
+            self.macs += macs
+            self.requests += requests
+
+    def finish(self):
+        with self.lock:
+            self.phase = "idle"
+            self.ended = time.monotonic()
+
+    def snapshot(self):
+        """返回当前进度字典：已完成/总设备数、最近完成的设备、MAC 数、每秒 SNMP 请求数和预计剩余秒数"""
+        with self.lock:
+            elapsed = (self.ended or time.monotonic()) - self.started if self.started else 0
+            eta = None
+            if self.phase == "polling" and self.hosts_done:
+                eta = round(elapsed / self.hosts_done * (self.hosts_total - self.hosts_done), 1)
+            return {
+                "running": self.phase != "idle",
+                "sweep": self.sweeps,
+                "phase": self.phase,
+                "network": self.network,
+                "hosts_done": self.hosts_done,
+                "hosts_total": self.hosts_total,
+                "hosts_failed": self.hosts_failed,
+                "current_host": self.current_host,
+                "macs": self.macs,
+                "requests": self.requests,
+                "requests_per_second": round(self.requests / elapsed, 1) if elapsed else 0,
+                "elapsed_seconds": round(elapsed, 1),
+                "eta_seconds": eta,
+            }
+
+sweep_progress = SweepProgress()
+
+def get_adaptive_config(config):
+    """合并 schedule.adaptive 配置和默认值，未启用时返回 None"""
+    adaptive = {**DEFAULT_ADAPTIVE, **(config.get("schedule", {}).get("adaptive") or {})}
+    if not adaptive["enabled"]:
+        return None
+    adaptive["default_minutes"] = config["schedule"]["interval_minutes"]
+    return adaptive
+
+def get_trunk_config(config):
+    """合并 snmp.trunk 配置和默认值，mode 为 off 时返回 None"""
+    trunk = {**DEFAULT_TRUNK, **(config.get("snmp", {}).get("trunk") or {})}
+    if trunk["mode"] not in ("flag", "drop"):
+        return None
+    return trunk
+
+def get_async_config(config):
+    """snmp.backend 为 async 时合并 snmp.async 配置和默认值，否则返回 None（使用 easysnmp）"""
+    if config.get("snmp", {}).get("backend", "easysnmp") != "async":
+        return None
+    return {**DEFAULT_ASYNC, **(config["snmp"].get("async") or {})}
+
+def collect_snmp(shard=None):
+    """使用配置文件中的设置进行采集
+
+    shard 为 (i, n) 时只采集本节点负责的第 i 个分片（1 <= i <= n），用于多台机器分担采集。
+    """
+    with collection_lock:
+        _collect_snmp(shard=shard)
+
+def collect_due_devices():
+    """自适应轮询：只采集已到轮询时间的已知设备，没有到期设备或已有采集在进行时直接返回"""
+    with open("config.yaml") as f:
+        config = yaml.safe_load(f)
+    if get_adaptive_config(config) is None or not collection_lock.acquire(blocking=False):
+        return
+    try:
+        db = SessionLocal()
+        try:
+            due = db.query(KnownAgent).filter(
+                (KnownAgent.next_poll == None) | (KnownAgent.next_poll <= get_shanghai_time())  # noqa: E711
+            ).count()
+        finally:
+            db.close()
+        if due:
+            _collect_snmp(discover=False)
+    finally:
+        collection_lock.release()
+
+def _collect_snmp(discover=True, shard=None):
     with open("config.yaml") as f:
         config = yaml.safe_load(f)
 
@@ -20,108 +211,712 @@ def collect_snmp():
     # 从配置文件中获取超时和重试设置，如果没有则使用默认值
     timeout = config["snmp"].get("timeout", 2)
     retries = config["snmp"].get("retries", 1)
-    
-    _perform_snmp_collection(network, community, timeout, retries)
+    max_workers = config["snmp"].get("max_workers", DEFAULT_MAX_WORKERS)
+    processes = (config["snmp"].get("shards") or {}).get("processes", 1)
+
+    # 存活探测设置：已知设备每次都采集，其余地址每 full_sweep_every 次才重新探测
+    discovery = config["snmp"].get("discovery") or {}
+    probe_timeout = discovery.get("timeout", DEFAULT_PROBE_TIMEOUT) if discovery.get("enabled", True) else 0
+    probe_workers = discovery.get("workers", DEFAULT_PROBE_WORKERS)
+    full_sweep_every = max(1, discovery.get("full_sweep_every", DEFAULT_FULL_SWEEP_EVERY))
+
+    global _scheduled_runs
+    full_sweep = False
+    if discover:
+        full_sweep = _scheduled_runs % full_sweep_every == 0
+        _scheduled_runs += 1
+
+    # 启用自适应轮询后，已知设备只在到期时采集，定时任务只负责发现新设备
+    adaptive = get_adaptive_config(config)
+    _perform_snmp_collection(network, community, timeout, retries, max_workers,
+                             probe_timeout=probe_timeout, probe_workers=probe_workers,
+                             full_sweep=full_sweep, bulk_config=config["snmp"].get("bulk"),
+                             adaptive=adaptive, due_only=adaptive is not None,
+                             processes=processes, shard=shard, trunk=get_trunk_config(config),
+                             async_config=get_async_config(config))
 
 def collect_snmp_manual(network_str, community_str):
     """手动指定网络和community进行采集"""
     try:
         network = ipaddress.ip_network(network_str)
-        # 使用默认的超时和重试设置
-        _perform_snmp_collection(network, community_str)
     except ValueError as e:
         raise Exception(f"无效的网络地址: {network_str} - {str(e)}")
+    # 使用默认的超时、重试和并发设置；GETBULK、上联端口识别和 SNMP 后端与定时采集相同
+    with open("config.yaml") as f:
+        config = yaml.safe_load(f)
+    with collection_lock:
+        _perform_snmp_collection(network, community_str, bulk_config=config["snmp"].get("bulk"),
+                                 trunk=get_trunk_config(config), async_config=get_async_config(config))
+
+def _oid_key(oid):
+    """把数字 OID 字符串转成可比较的整数元组"""
+    return tuple(int(part) for part in oid.split('.'))
+
+def _full_oid(entry):
+    """拼出 easysnmp 返回值的完整数字 OID（不带前导点）"""
+    oid = entry.oid.strip('.')
+    return f"{oid}.{entry.oid_index}" if entry.oid_index else oid
+
+def _is_too_big(error):
+    """判断异常是否是代理返回的 tooBig 错误"""
+    message = str(error).lower().replace(' ', '')
+    return 'toobig' in message or 'toolarge' in message
+
+class _EasySnmpTransport:
+    """easysnmp 传输：阻塞的 Session 调用用 asyncio.to_thread 放进事件循环的线程池，每台设备一个会话"""
+
+    def __init__(self, host_str, community, timeout, retries):
+        self.session = Session(
+            hostname=host_str,
+            community=community,
+            version=2,  # SNMP v2c
+            timeout=timeout,
+            retries=retries,
+            use_numeric=True  # 返回数字 OID，便于判断是否越过表尾
+        )
+
+    async def get(self, oids):
+        return await asyncio.to_thread(self.session.get, oids)
+
+    async def get_bulk(self, oid, max_repetitions):
+        return await asyncio.to_thread(self.session.get_bulk, [oid], 0, max_repetitions)
+
+class _EngineTransport:
+    """异步引擎传输：请求经 engine 的共享 UDP 套接字发出，等待应答时不占线程"""
+
+    def __init__(self, engine, host_str, community, timeout, retries):
+        self.engine = engine
+        self.host = host_str
+        self.community = community
+        self.timeout = timeout
+        self.retries = retries
+
+    async def get(self, oids):
+        return await self.engine.request(self.host, self.community, snmp_async.GET, oids, self.timeout, self.retries)
+
+    async def get_bulk(self, oid, max_repetitions):
+        return await self.engine.request(self.host, self.community, snmp_async.GETBULK, [oid],
+                                         self.timeout, self.retries, 0, max_repetitions)
+
+def _make_engine(async_config):
+    return snmp_async.AsyncSnmpEngine(async_config["max_in_flight"], async_config["per_host"],
+                                      async_config["min_interval_ms"] / 1000)
+
+@contextlib.asynccontextmanager
+async def _snmp_transports(async_config, workers):
+    """按 SNMP 后端准备传输，生成 transport(host_str, community, timeout, retries) 工厂
+
+    async_config 为 None 时用 easysnmp，阻塞调用最多占 workers 个线程；
+    否则所有设备共用一个异步引擎。采集逻辑只面向传输对象的 get / get_bulk，两种后端共用。
+    """
+    if async_config:
+        engine = _make_engine(async_config)
+        await engine.start()
+        try:
+            yield lambda *args: _EngineTransport(engine, *args)
+        finally:
+            engine.close()
+    else:
+        # asyncio.run 结束时会关闭默认线程池
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="snmp"))
+        yield _EasySnmpTransport
+
+class _CountingSession:
+    """在 SNMP 传输之上按 GETBULK 取表，并统计实际发出的 SNMP 请求（PDU）数"""
+
+    def __init__(self, transport, max_repetitions=DEFAULT_MAX_REPETITIONS):
+        self.transport = transport
+        self.max_repetitions = max(1, max_repetitions)
+        self.requests = 0
 
-def _get_interface_vlan(session, port_number, vlan_names):
-    """尝试获取接口的 VLAN 信息"""
+    async def get(self, oids):
+        self.requests += 1
+        return await self.transport.get(oids)
+
+    async def bulk_table(self, oid):
+        """逐批用 GETBULK 取回 oid 子树，按行生成 (索引, 值)
+
+        生成器是惰性的，调用方边取边解析，整张表不会一次性留在内存里。
+        代理返回 tooBig 时把 max_repetitions 减半重试；代理截断响应
+        （返回行数少于请求行数但表还没结束）时把 max_repetitions 降到实际返回的行数。
+        """
+        prefix = oid.strip('.') + '.'
+        current = oid.strip('.')
+        while True:
+            try:
+                self.requests += 1
+                batch = await self.transport.get_bulk(current, self.max_repetitions)
+            except Exception as e:
+                if _is_too_big(e) and self.max_repetitions > 1:
+                    self.max_repetitions //= 2
+                    continue
+                raise
+
+            rows, current, finished = _table_batch(prefix, current, batch)
+            for row in rows:
+                yield row
+            if finished:
+                return
+            if len(batch) < self.max_repetitions:
+                self.max_repetitions = len(batch)
+
+def _table_batch(prefix, current, batch):
+    """解析一批 GETBULK 结果，返回 (属于该表的 (索引, 值) 列表, 最后一个 OID, 表是否已经结束)"""
+    rows = []
+    if not batch:
+        return rows, current, True
+    for entry in batch:
+        full = _full_oid(entry)
+        if entry.snmp_type in ('ENDOFMIBVIEW', 'NOSUCHOBJECT', 'NOSUCHINSTANCE') \
+                or not full.startswith(prefix):
+            return rows, current, True
+        # 代理返回的 OID 没有递增时停止，避免死循环
+        if _oid_key(full) <= _oid_key(current):
+            return rows, current, True
+        rows.append((full[len(prefix):], entry.value))
+        current = full
+    return rows, current, False
+
+def _get_max_repetitions(host_str, bulk_config):
+    """按设备地址取 GETBULK max_repetitions
+
+    bulk_config["overrides"] 的键可以是单个 IP 或 CIDR 网段（一类设备），
+    匹配到多个时取前缀最长的一个。
+    """
+    bulk_config = bulk_config or {}
+    value = bulk_config.get("max_repetitions", DEFAULT_MAX_REPETITIONS)
+    best_prefix = -1
+    address = ipaddress.ip_address(host_str)
+    for key, override in (bulk_config.get("overrides") or {}).items():
+        override_network = ipaddress.ip_network(str(key), strict=False)
+        if address in override_network and override_network.prefixlen > best_prefix:
+            best_prefix = override_network.prefixlen
+            value = override
+    return value
+
+async def _get_port_vlans(session):
+    """用 GETBULK 取回整张 dot1qPvid 表，返回 {端口号: VLAN ID}"""
+    port_vlans = {}
     try:
-        # 尝试标准 802.1Q PVID OID
-        vlan_oid = f"{OID_DOT1Q_VLAN}.{port_number}"
-        vlan_entry = session.get(vlan_oid)
-        if vlan_entry and vlan_entry.value != '0':
-            vlan_id = vlan_entry.value
-            # 查找 VLAN 名称，如果找不到则使用 VLAN ID
-            vlan_name = vlan_names.get(vlan_id, f"VLAN {vlan_id}")
-            return vlan_name
-    except Exception as e:
-        # 记录错误但继续尝试其他方法
+        async for port_number, vlan_id in session.bulk_table(OID_DOT1Q_VLAN):
+            port_vlans[port_number] = vlan_id
+    except Exception:
+        # 设备不支持 Q-BRIDGE MIB 时所有端口都按默认 VLAN 处理
         pass
+    return port_vlans
+
+def _get_interface_vlan(port_vlans, port_number, vlan_names):
+    """从本次轮询缓存的 PVID 表中查出接口的 VLAN 名称"""
+    vlan_id = port_vlans.get(port_number)
+    if vlan_id and vlan_id != '0':
+        # 查找 VLAN 名称，如果找不到则使用 VLAN ID
+        return vlan_names.get(vlan_id, f"VLAN {vlan_id}")
     
     # 如果无法获取接口 VLAN 信息，使用默认 VLAN（VLAN 1）
     default_vlan = "1"
     return vlan_names.get(default_vlan, f"VLAN {default_vlan}")
 
-def _perform_snmp_collection(network, community, timeout=2, retries=1):
-    """执行SNMP采集的核心函数"""
+def _fdb_row(index, port, port_vlans, vlan_names):
+    """把 dot1dTpFdbPort 的一行转成 (VLAN 名称, MAC, 端口)"""
+    # 表索引就是 MAC 地址的6个字节，值是端口号
+    mac_parts = index.split('.')[-6:]
+    mac = ":".join(["%02x" % int(x) for x in mac_parts])
+
+    # 获取接口的 VLAN 信息
+    return _get_interface_vlan(port_vlans, port, vlan_names), mac, port
+
+async def _get_lldp_ports(session):
+    """有 LLDP 邻居的网桥端口号集合
+
+    lldpRemTable 的索引里是 lldpLocPortNum，这里按多数设备的实现把它当作 ifIndex，
+    再用 dot1dBasePortIfIndex 换算成转发表里的网桥端口号；换算不到的按原值处理。
+    设备不支持 LLDP-MIB 时返回空集合。
+    """
+    try:
+        local_ports = {index.split('.')[1] async for index, _ in session.bulk_table(OID_LLDP_REM_CHASSIS)}
+        if not local_ports:
+            return set()
+        bridge_ports = {if_index: port async for port, if_index in session.bulk_table(OID_BASE_PORT_IFINDEX)}
+    except Exception:
+        return set()
+    return {bridge_ports.get(port, port) for port in local_ports}
+
+def _get_trunk_ports(rows, trunk, lldp_ports=()):
+    """按每个端口学习到的 MAC 数判定上联端口，再加上有 LLDP 邻居的端口"""
+    counts = Counter(port for _, _, port in rows)
+    ports = {port for port, count in counts.items() if count > trunk["max_macs"]}
+    return frozenset(ports | set(lldp_ports))
+
+def _discover_agents(hosts, community, timeout, max_workers, async_config=None):
+    """并发探测一批地址（发送一次 sysObjectID/sysUpTime GET，不重试），按原顺序返回有应答的地址
+
+    同时在途的探测数为 max_workers，使用异步引擎时为 max_in_flight。
+    """
+    if not hosts:
+        return []
+    limit = async_config["max_in_flight"] if async_config else max_workers
+
+    async def discover():
+        alive = set()
+        async with _snmp_transports(async_config, limit) as transport:
+            async def probe(host_str):
+                try:
+                    await transport(host_str, community, timeout, 0).get([OID_SYS_OBJECT_ID, OID_SYS_UPTIME])
+                    alive.add(host_str)
+                except Exception:
+                    pass
+
+            await snmp_async.run_bounded(hosts, limit, probe)
+        return alive
+
+    alive = asyncio.run(discover())
+    return [host_str for host_str in hosts if host_str in alive]
+
+def _load_known_agents(db, hosts):
+    """返回 hosts 中已记录为 SNMP 代理的地址集合"""
+    host_set = set(hosts)
+    return {agent.ip for agent in db.query(KnownAgent).all() if agent.ip in host_set}
+
+def _remember_agents(db, agents):
+    """把本次有应答的地址写入已知代理表"""
+    now = get_shanghai_time()
+    for host_str in agents:
+        agent = db.get(KnownAgent, host_str)
+        if agent is None:
+            db.add(KnownAgent(ip=host_str, first_seen=now, last_seen=now))
+        else:
+            agent.last_seen = now
+    db.commit()
+
+async def _get_fingerprint(session):
+    """取 sysUpTime 和各转发数据库的动态表项数，拼成 "uptime|count,count,..."
+
+    设备不支持 dot1qFdbDynamicCount 时返回 None，此时不会跳过完整遍历。
+    """
+    try:
+        uptime = (await session.get([OID_SYS_UPTIME]))[0].value
+        counts = [count async for _, count in session.bulk_table(OID_FDB_DYNAMIC_COUNT)]
+    except Exception:
+        return None
+    if not counts:
+        return None
+    return f"{uptime}|{','.join(counts)}"
+
+def _fdb_unchanged(previous, current):
+    """转发表计数与上次相同且设备没有重启（sysUpTime 没有变小）时认为转发表没有变化"""
+    if not previous or not current:
+        return False
+    previous_uptime, previous_counts = previous.split('|', 1)
+    uptime, counts = current.split('|', 1)
+    try:
+        rebooted = int(uptime) < int(previous_uptime)
+    except ValueError:
+        return False
+    return counts == previous_counts and not rebooted
+
+async def _poll_host(transport, host_str, max_repetitions=DEFAULT_MAX_REPETITIONS, previous_fingerprint=None,
+                     check_fingerprint=False, trunk=None):
+    """采集单台设备，只做 SNMP 请求和解析，不访问数据库
+
+    transport 为该设备的 SNMP 传输（见 _snmp_transports），两种 SNMP 后端共用这一份采集逻辑。
+    check_fingerprint 为 True 时先取 sysUpTime 和转发表计数，与 previous_fingerprint
+    相同则跳过完整遍历（previous_fingerprint 为 None 时只记录不跳过）。
+    trunk 为上联端口识别配置（None 表示不识别）。
+    返回 PollResult，失败时直接抛出异常。
+    """
+    started = time.perf_counter()
+    session = _CountingSession(transport, max_repetitions)
+    messages = []
+    phases = {}
+
+    fingerprint = None
+    if check_fingerprint:
+        fingerprint = await _get_fingerprint(session)
+        phases["fingerprint"] = time.perf_counter() - started
+        if _fdb_unchanged(previous_fingerprint, fingerprint):
+            return PollResult(messages, None, session.requests, fingerprint, time.perf_counter() - started, phases,
+                              frozenset())
+
+    phase_started = time.perf_counter()
+    # 获取 VLAN 名称映射表
+    vlan_names = {}
+    try:
+        async for vlan_id, vlan_name in session.bulk_table(OID_VLAN_NAME):
+            vlan_names[vlan_id] = vlan_name
+        messages.append(f"成功获取VLAN名称: {host_str}")
+    except Exception as e:
+        messages.append(f"获取VLAN名称失败: {host_str} - {str(e)}")
+
+    # 整张 PVID 表每台设备只取一次，之后按端口查字典
+    port_vlans = await _get_port_vlans(session)
+    phases["vlan"] = time.perf_counter() - phase_started
+    phase_started = time.perf_counter()
+
+    # 使用 GETBULK 逐批获取 MAC 地址表，边取边解析
+    rows = [_fdb_row(index, port, port_vlans, vlan_names) async for index, port in session.bulk_table(OID_MAC_TABLE)]
+    phases["fdb"] = time.perf_counter() - phase_started
+
+    trunk_ports = frozenset()
+    if trunk:
+        phase_started = time.perf_counter()
+        trunk_ports = _get_trunk_ports(rows, trunk, await _get_lldp_ports(session) if trunk["lldp"] else ())
+        phases["trunk"] = time.perf_counter() - phase_started
+
+    return PollResult(messages, rows, session.requests, fingerprint, time.perf_counter() - started, phases,
+                      trunk_ports)
+
+def _poll_jobs(jobs, community, timeout, retries, check_fingerprint, max_workers, trunk=None, async_config=None):
+    """在后台线程的事件循环里轮询 jobs [(设备地址, max_repetitions, 上次指纹), ...]
+
+    同时轮询最多 max_workers 台设备，使用异步引擎时为 max_hosts 台。
+    按完成顺序生成 (设备地址, PollResult, None)，失败时为 (设备地址, None, 错误信息)。
+    """
+    limit = async_config["max_hosts"] if async_config else max_workers
+
+    async def produce(emit):
+        async with _snmp_transports(async_config, limit) as transport:
+            async def poll(job):
+                host_str, max_repetitions, previous = job
+                try:
+                    result = await _poll_host(transport(host_str, community, timeout, retries), host_str,
+                                              max_repetitions, previous, check_fingerprint, trunk)
+                except Exception as e:
+                    emit((host_str, None, str(e)))
+                else:
+                    emit((host_str, result, None))
+
+            await snmp_async.run_bounded(jobs, limit, poll)
+
+    return snmp_async.iterate_in_thread(produce)
+
+def _poll_shard(shard, jobs, community, timeout, retries, check_fingerprint, max_workers, trunk, async_config,
+                result_queue):
+    """分片进程的入口：轮询分到的设备，把解析好的结果逐台放进队列，最后放入本分片的吞吐统计"""
+    started = time.perf_counter()
+    stats = {"shard": shard, "pid": os.getpid(), "hosts": 0, "failed": 0, "rows": 0, "requests": 0}
+    for host_str, result, error in _poll_jobs(jobs, community, timeout, retries, check_fingerprint, max_workers,
+                                              trunk, async_config):
+        stats["hosts"] += 1
+        if result is None:
+            stats["failed"] += 1
+        else:
+            stats["rows"] += len(result.rows or [])
+            stats["requests"] += result.requests
+        result_queue.put((host_str, result, error))
+    stats["seconds"] = time.perf_counter() - started
+    result_queue.put((None, stats, None))
+
+def _poll_in_processes(jobs, community, timeout, retries, check_fingerprint, max_workers, processes, shard_stats,
+                       trunk=None, async_config=None):
+    """把设备分给 processes 个进程并行轮询，结果经本地队列交回调用线程（唯一的数据库写入方）
+
+    每个进程有自己的 SNMP 会话和 max_workers / processes 个线程，OID 解析和 MAC 格式化
+    不再挤在同一个 GIL 上。进程用 fork 启动：spawn 会在子进程里重新执行 app.py 的顶层代码
+    （包括启动调度器），而子进程只做 SNMP 和解析，不使用继承来的数据库连接。
+    使用异步引擎时每个进程各有一个引擎，在途请求数和同时轮询的设备数同样按进程数均分。
+    生成的内容与 _poll_jobs 相同；每个分片结束时把吞吐统计追加到 shard_stats。
+    """
+    if async_config:
+        async_config = {**async_config,
+                        "max_in_flight": max(1, async_config["max_in_flight"] // processes),
+                        "max_hosts": max(1, async_config["max_hosts"] // processes)}
+    context = multiprocessing.get_context("fork")
+    result_queue = context.Queue()
+    workers = []
+    for index in range(processes):
+        shard_jobs = jobs[index::processes]
+        if not shard_jobs:
+            continue
+        worker = context.Process(
+            target=_poll_shard, daemon=True,
+            args=(index + 1, shard_jobs, community, timeout, retries, check_fingerprint,
+                  max(1, max_workers // processes), trunk, async_config, result_queue),
+        )
+        worker.start()
+        workers.append(worker)
+
+    pending = len(workers)
+    while pending:
+        try:
+            host_str, result, error = result_queue.get(timeout=1)
+        except queue.Empty:
+            # 子进程异常退出时不再等待它的结果
+            if not any(worker.is_alive() for worker in workers):
+                break
+            continue
+        if host_str is None:
+            shard_stats.append(result)
+            pending -= 1
+            continue
+        yield host_str, result, error
+    for worker in workers:
+        worker.join()
+
+def _port_sort_key(port):
+    return (0, int(port)) if port.isdigit() else (1, port)
+
+def _is_timeout(error):
+    message = error.lower()
+    return 'timeout' in message or 'timed out' in message
+
+def _record_poll_metrics(result, error):
+    """把单台设备的轮询结果计入指标；在写库线程里记录，多进程轮询时子进程的结果也不会丢"""
+    if result is None:
+        metrics.POLLS.inc("timeout" if _is_timeout(error) else "error")
+        return
+    metrics.POLLS.inc("skipped" if result.rows is None else "success")
+    metrics.POLL_SECONDS.observe(result.seconds)
+    for phase, seconds in result.phases.items():
+        metrics.POLL_PHASE_SECONDS.observe(seconds, phase)
+    metrics.SNMP_REQUESTS.inc(amount=result.requests)
+    if result.rows is not None:
+        metrics.WALK_ROWS.observe(len(result.rows))
+
+def _update_poll_state(db, host_str, now, result, changed, total, adaptive):
+    """记录设备本次轮询的时间、耗时和指纹；启用自适应轮询时按绑定变化调整下次轮询时间
+
+    变化占比达到 busy_churn 时间隔减半，完全没有变化时间隔放大 1.5 倍，其余保持不变，
+    并限制在 [min_minutes, max_minutes] 之内。
+    """
+    agent = db.get(KnownAgent, host_str)
+    if agent is None:
+        agent = KnownAgent(ip=host_str, first_seen=now, last_seen=now)
+        db.add(agent)
+    # 第一次轮询所有绑定都是新的，不计入变化
+    first_poll = agent.last_poll is None
+    agent.last_poll = now
+    agent.last_duration = result.seconds
+    agent.fingerprint = result.fingerprint
+    agent.skipped = (agent.skipped or 0) + 1 if result.rows is None else 0
+    agent.last_seen = now
+    agent.failures = 0
+    if adaptive is None:
+        return
+    if first_poll:
+        agent.poll_interval = adaptive["default_minutes"] * 60
+        agent.next_poll = now + datetime.timedelta(seconds=agent.poll_interval)
+        return
+    fraction = changed / total if total else 0.0
+    agent.churn = fraction if agent.churn is None else 0.5 * agent.churn + 0.5 * fraction
+    interval = agent.poll_interval or adaptive["default_minutes"] * 60
+    if fraction >= adaptive["busy_churn"]:
+        interval /= 2
+    elif changed == 0:
+        interval *= 1.5
+    interval = min(max(interval, adaptive["min_minutes"] * 60), adaptive["max_minutes"] * 60)
+    agent.poll_interval = int(interval)
+    agent.next_poll = now + datetime.timedelta(seconds=agent.poll_interval)
+
+def _record_poll_failure(db, host_str, now, adaptive):
+    """已知设备轮询失败或存活探测无应答：失败次数加一，启用自适应轮询时按次数退避下次轮询时间
+
+    退避间隔从 min_minutes 起每次翻倍，最长 max_minutes；不改 poll_interval，恢复后按原间隔轮询。
+    """
+    agent = db.get(KnownAgent, host_str)
+    if agent is None:
+        return
+    agent.failures = (agent.failures or 0) + 1
+    if adaptive is None:
+        return
+    backoff = min(adaptive["min_minutes"] * 2 ** agent.failures, adaptive["max_minutes"]) * 60
+    agent.next_poll = now + datetime.timedelta(seconds=backoff)
+
+def _expire_known_agents(db, now, days):
+    """删除超过 days 天没有应答的已知设备，返回删除的数量；设备恢复后由全网段探测重新发现"""
+    cutoff = now - datetime.timedelta(days=days)
+    expired = db.query(KnownAgent).filter(KnownAgent.failures > 0, KnownAgent.last_seen < cutoff).delete(
+        synchronize_session=False)
+    db.commit()
+    return expired
+
+def _perform_snmp_collection(network, community, timeout=2, retries=1, max_workers=DEFAULT_MAX_WORKERS,
+                             probe_timeout=DEFAULT_PROBE_TIMEOUT, probe_workers=DEFAULT_PROBE_WORKERS,
+                             full_sweep=True, bulk_config=None, adaptive=None, due_only=False,
+                             processes=1, shard=None, trunk=None, async_config=None):
+    """执行SNMP采集的核心函数
+
+    先用一次短超时的 GET 探测存活的 SNMP 代理（probe_timeout 为 0 时跳过探测），
+    只对有应答的设备做完整的表遍历。已知代理排在最前面；full_sweep 为 False 时
+    不再探测网段中其余的地址。
+
+    设备轮询在后台线程的事件循环中并发进行（最多 max_workers 个同时在途，easysnmp 的阻塞调用
+    在同样大小的线程池里执行），所有数据库写入都在调用线程中串行完成，SQLite 不会出现并发写。
+    表遍历使用 GETBULK，每台设备的 max_repetitions 由 bulk_config 决定。
+
+    adaptive 为自适应轮询配置（None 表示不启用）：due_only 为 True 时已知设备只采集
+    已到 next_poll 的；区间模式下 skip_unchanged 开启时，转发表计数没变的设备跳过完整遍历，
+    只延续已有区间（连续跳过 max_skips 次后强制完整遍历一次）。已知设备轮询失败或探测无应答时
+    下次轮询时间按失败次数退避，超过 expire_days 天没有应答的从已知设备中删除。
+
+    processes 大于 1 时设备分给多个进程轮询，解析好的结果仍由调用线程统一写入。
+    shard 为 (i, n) 时只处理地址按 n 取模落在第 i 个分片的设备，供多个节点分担同一网段。
+
+    async_config 不为 None 时探测和轮询都用异步引擎（snmp_async），不再每台在途设备占一个线程。
+
+    trunk 为上联端口识别配置（None 表示不识别）：mode 为 drop 时上联端口上的 MAC 不写入，
+    为 flag 时写入并标记 is_trunk；两种模式下当前位置索引都只记录接入端口。
+    """
     db = SessionLocal()
+    sweep_progress.begin(network)
     try:
-        host_count = len(list(network.hosts()))
+        all_hosts = [str(host) for host in network.hosts()]
+        if shard:
+            index, count = shard
+            all_hosts = [h for h in all_hosts if int(ipaddress.ip_address(h)) % count == index - 1]
+        if adaptive:
+            expired = _expire_known_agents(db, get_shanghai_time(), adaptive["expire_days"])
+            if expired:
+                db.add(LogEntry(message=f"删除超过 {adaptive['expire_days']} 天无应答的已知设备 {expired} 个"))
+                db.commit()
+                query_cache.bump()
+        known = _load_known_agents(db, all_hosts)
+        candidates = [h for h in all_hosts if h in known]
+        agents = {agent.ip: agent for agent in db.query(KnownAgent).all()}
+        if due_only:
+            now = get_shanghai_time().replace(tzinfo=None)
+            candidates = [h for h in candidates if agents[h].next_poll is None or agents[h].next_poll <= now]
+        if full_sweep:
+            candidates += [h for h in all_hosts if h not in known]
+
+        if probe_timeout:
+            hosts = _discover_agents(candidates, community, probe_timeout, probe_workers, async_config)
+            _remember_agents(db, hosts)
+            now = get_shanghai_time()
+            responded = set(hosts)
+            for host_str in candidates:
+                if host_str in known and host_str not in responded:
+                    _record_poll_failure(db, host_str, now, adaptive)
+            db.add(LogEntry(message=f"存活探测完成: {len(hosts)}/{len(candidates)} 个地址有SNMP应答"
+                                    f"（已知设备 {len(known)} 个，{'全网段' if full_sweep else '仅已知设备'}）"))
+            db.commit()
+            query_cache.bump()
+        else:
+            hosts = candidates
+
+        host_count = len(hosts)
+        sweep_progress.polling(host_count)
+        location_index.ensure_loaded()
         processed = 0
         successful_hosts = 0
-        
-        for host in network.hosts():
+        rows_written = 0
+        trunk_dropped = 0
+        write_seconds = 0.0
+
+        # 跳过完整遍历只适用于区间模式：history 模式每次都要保存完整快照
+        check_fingerprint = bool(adaptive and adaptive["skip_unchanged"] and STORAGE_MODE == "interval")
+
+        def previous_fingerprint(host_str):
+            agent = agents.get(host_str)
+            if agent is None or (agent.skipped or 0) >= adaptive["max_skips"]:
+                return None
+            return agent.fingerprint
+
+        jobs = [(host_str, _get_max_repetitions(host_str, bulk_config),
+                 previous_fingerprint(host_str) if check_fingerprint else None) for host_str in hosts]
+        shard_stats = []
+        if processes > 1 and host_count > 1:
+            results = _poll_in_processes(jobs, community, timeout, retries, check_fingerprint,
+                                         max_workers, processes, shard_stats, trunk, async_config)
+        else:
+            results = _poll_jobs(jobs, community, timeout, retries, check_fingerprint, max_workers, trunk,
+                                 async_config)
+
+        for host_str, result, error in results:
             processed += 1
-            host_str = str(host)
+            failed = False
+            _record_poll_metrics(result, error)
             try:
-                # 创建 SNMP 会话
-                session = Session(
-                    hostname=host_str,
-                    community=community,
-                    version=2,  # SNMP v2c
-                    timeout=timeout,  # 增加超时时间
-                    retries=retries   # 增加重试次数
-                )
-                
-                # 获取 VLAN 名称映射表
-                vlan_names = {}
-                try:
-                    vlan_entries = session.walk(OID_VLAN_NAME)
-                    for entry in vlan_entries:
-                        vlan_id = entry.oid.split('.')[-1]
-                        vlan_names[vlan_id] = entry.value
-                    db.add(LogEntry(message=f"成功获取VLAN名称: {host_str}"))
-                except Exception as e:
-                    db.add(LogEntry(message=f"获取VLAN名称失败: {host_str} - {str(e)}"))
-                    db.commit()
-                
-                # 使用 walk 方法获取 MAC 地址表
-                mac_entries = session.walk(OID_MAC_TABLE)
-                
-                mac_count = 0
-                for entry in mac_entries:
-                    # 从 OID 中提取 MAC 地址
-                    oid_parts = entry.oid.split('.')
-                    mac_parts = oid_parts[-6:]  # 获取最后6个部分（MAC地址）
-                    mac = ":".join(["%02x" % int(x) for x in mac_parts])
-                    
-                    # 端口号是 entry 的值
-                    port = entry.value
-                    
-                    # 获取接口的 VLAN 信息
-                    vlan_name = _get_interface_vlan(session, port, vlan_names)
-                    
-                    # 保存到数据库
-                    db_entry = MacEntry(
-                        device=host_str,
-                        vlan=vlan_name,
-                        mac=mac,
-                        port=port
-                    )
-                    db.add(db_entry)
-                    mac_count += 1
-                
-                db.commit()
-                db.add(LogEntry(message=f"SNMP扫描成功: {host_str}, 发现 {mac_count} 个MAC地址"))
+                if error is not None:
+                    raise Exception(error)
+                rows = result.rows
+                trunk_ports = result.trunk_ports
+                for message in result.messages:
+                    db.add(LogEntry(message=message))
+
+                # 每台设备一个事务，MAC 记录按批 executemany 写入
+                write_start = time.perf_counter()
+                now = get_shanghai_time()
+                if rows is None:
+                    # 转发表计数没变：不做完整遍历，延续上次的区间
+                    extended = extend_mac_intervals(db, host_str, now)
+                    message = (f"SNMP扫描跳过: {host_str}, 转发表计数未变化, SNMP请求 {result.requests} 次, "
+                               f"延续区间 {extended} 个")
+                    changed, total = 0, extended
+                    rows = []
+                    macs, inserted = None, 0
+                else:
+                    message = (f"SNMP扫描成功: {host_str}, 发现 {len(rows)} 个MAC地址, "
+                               f"SNMP请求 {result.requests} 次")
+                    if trunk_ports:
+                        message += f", 上联端口 {','.join(sorted(trunk_ports, key=_port_sort_key))}"
+                        if trunk["mode"] == "drop":
+                            edge_rows = [row for row in rows if row[2] not in trunk_ports]
+                            trunk_dropped += len(rows) - len(edge_rows)
+                            message += f"（丢弃 {len(rows) - len(edge_rows)} 条）"
+                            rows = edge_rows
+                    if STORAGE_MODE == "interval":
+                        opened, extended = record_mac_intervals(db, host_str, rows, now, trunk_ports=trunk_ports)
+                        message += f", 新增区间 {opened} 个, 延续区间 {extended} 个"
+                        changed = opened
+                        macs, inserted = [mac for _, mac, _ in rows], opened
+                    else:
+                        if adaptive:
+                            agent = agents.get(host_str)
+                            previous = previous_bindings(db, host_str, agent.last_poll if agent else None)
+                            changed = len(set(rows) - previous)
+                        else:
+                            changed = 0
+                        bulk_insert_mac_entries(db, [(host_str, vlan_name, mac, port, now, port in trunk_ports)
+                                                     for vlan_name, mac, port in rows])
+                        macs, inserted, extended = [mac for _, mac, _ in rows], len(rows), 0
+                    total = len(rows)
+                _update_poll_state(db, host_str, now, result, changed, total, adaptive)
+                refresh_daily_summary(db, host_str, now, macs, inserted, extended)
+                db.add(LogEntry(message=message))
+                commit_start = time.perf_counter()
                 db.commit()
+                metrics.DB_COMMIT_SECONDS.observe(time.perf_counter() - commit_start)
+                metrics.DB_WRITE_SECONDS.observe(time.perf_counter() - write_start)
+                write_seconds += time.perf_counter() - write_start
+                # 网页上缓存的日期列表、总数等随之作废
+                query_cache.bump()
+                rows_written += len(rows)
                 successful_hosts += 1
-                
+                # 提交成功后再更新当前位置索引，索引不会领先于数据库
+                if result.rows is None:
+                    location_index.touch_device(host_str, now)
+                else:
+                    location_index.update_device(host_str, [row for row in rows if row[2] not in trunk_ports], now)
+
             except Exception as e:
+                db.rollback()
                 error_msg = f"SNMP扫描失败: {host_str} - {str(e)}"
+                _record_poll_failure(db, host_str, get_shanghai_time(), adaptive)
                 db.add(LogEntry(message=error_msg))
                 db.commit()
+                query_cache.bump()
                 print(error_msg)  # 同时输出到控制台
-        
-        summary_msg = f"采集完成: 成功扫描 {successful_hosts}/{processed} 个主机"
+                failed = True
+            sweep_progress.host_done(host_str, len(result.rows or []) if result else 0,
+                                     result.requests if result else 0, failed)
+
+        for stats in sorted(shard_stats, key=lambda item: item["shard"]):
+            shard_msg = (f"分片 {stats['shard']}/{processes} (进程 {stats['pid']}): "
+                         f"{stats['hosts']} 台设备（失败 {stats['failed']}）, {stats['rows']} 条MAC, "
+                         f"SNMP请求 {stats['requests']} 次, 用时 {stats['seconds']:.1f} 秒 "
+                         f"({stats['rows'] / stats['seconds'] if stats['seconds'] else 0:.0f} 行/秒)")
+            db.add(LogEntry(message=shard_msg))
+            print(shard_msg)
+
+        if successful_hosts:
+            location_index.save()
+
+        rows_per_second = rows_written / write_seconds if write_seconds else 0
+        summary_msg = (f"采集完成: 成功扫描 {successful_hosts}/{processed} 个主机, "
+                       f"写入 {rows_written} 条MAC记录 ({rows_per_second:.0f} 行/秒)")
+        if trunk_dropped:
+            summary_msg += f", 丢弃上联端口记录 {trunk_dropped} 条"
         db.add(LogEntry(message=summary_msg))
         db.commit()
         print(summary_msg)
@@ -132,4 +927,6 @@ def _perform_snmp_collection(network, community, timeout=2, retries=1):
         db.commit()
         print(error_msg)
     finally:
-        db.close()
\ No newline at end of file
+        sweep_progress.finish()
+        query_cache.bump()
+        db.close()
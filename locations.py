@@ -0,0 +1,182 @@
+import datetime
+import json
+import os
+import sys
+import threading
+import yaml
+from db import SessionLocal, KnownAgent, MacEntry, MacInterval, get_mac_model, normalize_mac, tz_shanghai
+
+# "这个 MAC 现在在哪" 的内存索引：48 位 MAC（整数）-> 最近一次在哪台设备、哪个 VLAN/端口上看到。
+# 采集每写完一台设备就更新，每次采集结束后把快照写到磁盘，重启时从快照恢复，
+# 查询只是一次字典查找，不访问 mac_table。
+
+with open("config.yaml") as f:
+    config = yaml.safe_load(f)
+
+SNAPSHOT_PATH = (config.get("locations") or {}).get("snapshot", "data/locations.json")
+
+def mac_to_int(mac):
+    """把各种格式的 MAC 转成 48 位整数，格式不对时返回 None"""
+    value = normalize_mac(mac)
+    if len(value) != 12:
+        return None
+    try:
+        return int(value, 16)
+    except ValueError:
+        return None
+
+def int_to_mac(value):
+    raw = f"{value:012x}"
+    return ":".join(raw[i:i + 2] for i in range(0, 12, 2))
+
+def _timestamp(moment):
+    """数据库里读出的时间没有时区信息，按东八区处理"""
+    if moment.tzinfo is None:
+        moment = tz_shanghai.localize(moment)
+    return moment.timestamp()
+
+class LocationIndex:
+    """MAC 当前位置索引
+
+    entries: {MAC 整数: (设备, VLAN, 端口, 最后发现时间戳)}；
+    by_device: {设备: 该设备最近一次轮询看到的 MAC 集合}，用来处理从设备上消失的 MAC 和跳过的轮询。
+    设备、VLAN、端口字符串都 intern，几百万条记录也只占几百 MB 以内。
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.by_device = {}
+        self.loaded = False
+        self.loaded_mtime = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update_device(self, device, rows, now):
+        """用设备本次轮询的 (vlan, mac, port) 更新索引
+
+        同一 MAC 出现在多台设备上时以最后写入的为准；本次没看到、但索引里仍指向这台设备的 MAC
+        保留原位置和最后发现时间（即“最后已知位置”）。
+        """
+        timestamp = _timestamp(now)
+        device = sys.intern(device)
+        macs = set()
+        with self.lock:
+            for vlan, mac, port in rows:
+                value = mac_to_int(mac)
+                if value is None:
+                    continue
+                macs.add(value)
+                self.entries[value] = (device, sys.intern(vlan), sys.intern(str(port)), timestamp)
+            self.by_device[device] = macs
+
+    def touch_device(self, device, now):
+        """设备的转发表没有变化（跳过了完整遍历）：上次看到的 MAC 仍在原位，只更新最后发现时间"""
+        timestamp = _timestamp(now)
+        with self.lock:
+            for value in self.by_device.get(device, ()):
+                entry = self.entries.get(value)
+                if entry is not None and entry[0] == device:
+                    self.entries[value] = entry[:3] + (timestamp,)
+
+    def lookup(self, macs):
+        """批量查询，返回 {输入的 MAC: 位置字典或 None}"""
+        self._reload_if_changed()
+        results = {}
+        with self.lock:
+            for mac in macs:
+                value = mac_to_int(mac)
+                entry = self.entries.get(value) if value is not None else None
+                if entry is None:
+                    results[mac] = None
+                    continue
+                device, vlan, port, timestamp = entry
+                last_seen = datetime.datetime.fromtimestamp(timestamp, tz_shanghai)
+                results[mac] = {"mac": int_to_mac(value), "device": device, "vlan": vlan, "port": port,
+                                "last_seen": last_seen.isoformat(timespec="seconds")}
+        return results
+
+    def prune(self, before):
+        """删除最后发现时间早于 before 的条目（随过期数据一起清理）"""
+        cutoff = _timestamp(before)
+        with self.lock:
+            stale = [value for value, entry in self.entries.items() if entry[3] < cutoff]
+            for value in stale:
+                del self.entries[value]
+            for macs in self.by_device.values():
+                macs.difference_update(stale)
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_device.clear()
+
+    def save(self):
+        """把索引写到快照文件（先写临时文件再替换，读的一方不会看到半个文件）"""
+        with self.lock:
+            data = {
+                "version": 1,
+                "entries": [[value, *entry] for value, entry in self.entries.items()],
+                "devices": {device: list(macs) for device, macs in self.by_device.items()},
+            }
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+        self.loaded_mtime = os.stat(self.path).st_mtime
+
+    def ensure_loaded(self):
+        """第一次使用前加载；采集在保存快照前也要先加载，避免用不完整的索引覆盖快照"""
+        if not self.loaded:
+            self.load()
+
+    def load(self):
+        """从快照恢复，没有快照时从每台设备最近一次采集的记录重建；返回条目数"""
+        self.loaded = True
+        try:
+            with open(self.path) as f:
+                self.loaded_mtime = os.fstat(f.fileno()).st_mtime
+                data = json.load(f)
+        except FileNotFoundError:
+            self.rebuild()
+            return len(self.entries)
+        entries = {}
+        for value, device, vlan, port, timestamp in data["entries"]:
+            entries[value] = (sys.intern(device), sys.intern(vlan), sys.intern(port), timestamp)
+        by_device = {sys.intern(device): set(macs) for device, macs in data["devices"].items()}
+        with self.lock:
+            self.entries = entries
+            self.by_device = by_device
+        return len(entries)
+
+    def _reload_if_changed(self):
+        """快照被其他进程（例如 flask collect）更新过时重新加载"""
+        self.ensure_loaded()
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return
+        if self.loaded_mtime is None or mtime > self.loaded_mtime:
+            self.load()
+
+    def rebuild(self):
+        """从数据库重建：每台已知设备取最近一次成功轮询写入的绑定（走 device+timestamp 索引）"""
+        Model = get_mac_model()
+        seen = MacInterval.last_seen if Model is MacInterval else MacEntry.timestamp
+        db = SessionLocal()
+        try:
+            agents = db.query(KnownAgent.ip, KnownAgent.last_poll).filter(KnownAgent.last_poll != None)  # noqa: E711
+            # 先处理较早轮询的设备，同一 MAC 在多台设备上时保留最近的位置
+            for device, last_poll in sorted(agents, key=lambda agent: agent.last_poll):
+                rows = db.query(Model.vlan, Model.mac, Model.port).filter(Model.device == device, seen == last_poll)
+                self.update_device(device, rows, last_poll)
+        finally:
+            db.close()
+
+location_index = LocationIndex()
@@ -0,0 +1,143 @@
+import bisect
+import threading
+import yaml
+
+# 采集和网页请求的运行指标，/metrics 按 Prometheus 文本格式输出。
+# 不依赖 prometheus_client：每次记录只是加锁后累加几个数，开销很小；
+# config.yaml 中 metrics.enabled 为 false 时所有记录都直接返回。
+
+with open("config.yaml") as f:
+    config = yaml.safe_load(f)
+
+ENABLED = bool((config.get("metrics") or {}).get("enabled", True))
+
+# 默认的直方图分桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+POLL_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+ROW_BUCKETS = (0, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+
+_registry = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+            lines.extend(self._render_items(items))
+        return lines
+
+class Counter(_Metric):
+    """只增不减的计数"""
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        if not ENABLED:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def _render_items(self, items):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items]
+
+class Histogram(_Metric):
+    """按分桶累计观测值的分布，输出 _bucket / _sum / _count"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        if not ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # 每个桶只记本桶的次数，输出时再累加成 Prometheus 要求的累计值
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_items(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', le))} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Gauge(_Metric):
+    """抓取时才计算的当前值：func 返回 {标签值元组: 数值}"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, func, labels=()):
+        super().__init__(name, documentation, labels)
+        self.func = func
+
+    def render(self):
+        if ENABLED:
+            with self.lock:
+                self.values = self.func()
+        return super().render()
+
+    def _render_items(self, items):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                for key, value in items if value is not None]
+
+def render():
+    """所有指标的 Prometheus 文本格式"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# 采集
+POLL_SECONDS = Histogram("mactracker_poll_duration_seconds", "单台设备 SNMP 轮询耗时（含解析）", buckets=POLL_BUCKETS)
+POLL_PHASE_SECONDS = Histogram("mactracker_poll_phase_seconds",
+                               "单台设备轮询各阶段耗时：fingerprint / vlan（VLAN 名称和 PVID 表）/ fdb（转发表遍历）"
+                               " / trunk（上联端口识别）",
+                               labels=("phase",), buckets=POLL_BUCKETS)
+WALK_ROWS = Histogram("mactracker_walk_rows", "单台设备转发表遍历得到的行数", buckets=ROW_BUCKETS)
+SNMP_REQUESTS = Counter("mactracker_snmp_requests_total", "发出的 SNMP 请求（PDU）数")
+POLLS = Counter("mactracker_polls_total", "设备轮询次数，result 为 success / skipped / timeout / error", labels=("result",))
+DB_WRITE_SECONDS = Histogram("mactracker_db_write_seconds", "单台设备写库事务耗时（写入、汇总和提交）")
+DB_COMMIT_SECONDS = Histogram("mactracker_db_commit_seconds", "单台设备写库事务中 COMMIT 的耗时")
+
+# 网页
+HTTP_SECONDS = Histogram("mactracker_http_request_duration_seconds", "按路由统计的请求耗时",
+                         labels=("route", "method", "status"))
+COUNT_QUERY_SECONDS = Histogram("mactracker_count_query_seconds", "列表页总数 count() 查询耗时（未命中缓存时）",
+                                labels=("route",))
+CACHE_REQUESTS = Counter("mactracker_query_cache_requests_total", "网页查询结果缓存的命中/未命中次数",
+                         labels=("query", "result"))
@@ -0,0 +1,355 @@
+import asyncio
+import itertools
+import queue
+import random
+import socket
+import threading
+import time
+
+# 基于 asyncio 的 SNMP v2c 客户端：所有请求共用一个 UDP 套接字，按 request-id 把应答分发给等待的请求，
+# 单个进程可以同时有几千个请求在途；每台设备同时在途的请求数和相邻请求的间隔有上限，不会压垮设备。
+# 只实现采集用到的 GET / GETBULK 和 BER 编解码的相应部分。
+
+# BER 标签
+INTEGER = 0x02
+OCTET_STRING = 0x04
+NULL = 0x05
+OBJECT_ID = 0x06
+SEQUENCE = 0x30
+IP_ADDRESS = 0x40
+COUNTER32 = 0x41
+GAUGE32 = 0x42
+TIMETICKS = 0x43
+OPAQUE = 0x44
+COUNTER64 = 0x46
+NO_SUCH_OBJECT = 0x80
+NO_SUCH_INSTANCE = 0x81
+END_OF_MIB_VIEW = 0x82
+GET, GETNEXT, RESPONSE, GETBULK = 0xA0, 0xA1, 0xA2, 0xA5
+
+# 与 easysnmp 的 snmp_type 取值一致，采集代码按同样的方式判断表尾
+SNMP_TYPES = {
+    INTEGER: "INTEGER", OCTET_STRING: "OCTETSTR", NULL: "NULL", OBJECT_ID: "OBJECTID", IP_ADDRESS: "IPADDR",
+    COUNTER32: "COUNTER", GAUGE32: "GAUGE", TIMETICKS: "TICKS", OPAQUE: "OPAQUE", COUNTER64: "COUNTER64",
+    NO_SUCH_OBJECT: "NOSUCHOBJECT", NO_SUCH_INSTANCE: "NOSUCHINSTANCE", END_OF_MIB_VIEW: "ENDOFMIBVIEW",
+}
+
+# error-status 取值 -> 名称（只列常见的）
+ERROR_STATUS = {1: "tooBig", 2: "noSuchName", 3: "badValue", 4: "readOnly", 5: "genErr"}
+
+DEFAULT_MAX_IN_FLIGHT = 2000
+DEFAULT_PER_HOST = 1
+SNMP_PORT = 161
+# 很多请求同时在途时应答会集中到达，接收缓冲区调大一些以免丢包
+RECEIVE_BUFFER = 8 * 1024 * 1024
+
+
+class SnmpError(Exception):
+    pass
+
+
+class SnmpTimeout(SnmpError):
+    pass
+
+
+# ---- BER 编解码 ----
+
+def encode_length(length):
+    if length < 0x80:
+        return bytes([length])
+    raw = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes([0x80 | len(raw)]) + raw
+
+
+def encode_tlv(tag, payload):
+    return bytes([tag]) + encode_length(len(payload)) + payload
+
+
+def encode_integer(tag, value):
+    return encode_tlv(tag, value.to_bytes(max(1, (value.bit_length() + 8) // 8), "big", signed=True))
+
+
+def encode_unsigned(tag, value):
+    raw = value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big")
+    if raw[0] & 0x80:
+        raw = b"\x00" + raw
+    return encode_tlv(tag, raw)
+
+
+def encode_oid(oid):
+    """oid 为整数元组或点分字符串"""
+    if isinstance(oid, str):
+        oid = tuple(int(part) for part in oid.strip(".").split("."))
+    body = bytearray([oid[0] * 40 + oid[1]])
+    for arc in oid[2:]:
+        chunk = [arc & 0x7F]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7F))
+            arc >>= 7
+        body.extend(reversed(chunk))
+    return encode_tlv(OBJECT_ID, bytes(body))
+
+
+def encode_value(tag, value):
+    if tag == INTEGER:
+        return encode_integer(tag, value)
+    if tag in (COUNTER32, GAUGE32, TIMETICKS, COUNTER64):
+        return encode_unsigned(tag, value)
+    if tag == OCTET_STRING:
+        return encode_tlv(tag, value.encode() if isinstance(value, str) else value)
+    if tag == OBJECT_ID:
+        return encode_oid(value)
+    return encode_tlv(tag, b"")
+
+
+def decode_tlv(data, offset):
+    """返回 (标签, 内容, 下一个 TLV 的偏移)"""
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7F
+        length = int.from_bytes(data[offset:offset + size], "big")
+        offset += size
+    if offset + length > len(data):
+        raise ValueError("BER 长度超出报文")
+    return tag, data[offset:offset + length], offset + length
+
+
+def decode_integer(payload):
+    return int.from_bytes(payload, "big", signed=True)
+
+
+def decode_oid(payload):
+    first = payload[0]
+    oid = [first // 40, first % 40] if first < 80 else [2, first - 80]
+    arc = 0
+    for byte in payload[1:]:
+        arc = (arc << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            oid.append(arc)
+            arc = 0
+    return tuple(oid)
+
+
+def decode_value(tag, payload):
+    """按 easysnmp 的习惯把值转成字符串（表尾等异常值返回空字符串）"""
+    if tag == INTEGER:
+        return str(decode_integer(payload))
+    if tag in (COUNTER32, GAUGE32, TIMETICKS, COUNTER64):
+        return str(int.from_bytes(payload, "big"))
+    if tag == OCTET_STRING:
+        try:
+            return payload.decode("utf-8")
+        except UnicodeDecodeError:
+            return payload.decode("latin-1")
+    if tag == OBJECT_ID:
+        return ".".join(map(str, decode_oid(payload)))
+    if tag == IP_ADDRESS:
+        return ".".join(map(str, payload))
+    return ""
+
+
+def encode_request(community, pdu_type, request_id, oids, non_repeaters=0, max_repetitions=0):
+    """v2c 请求报文；GETBULK 时第二、三个整数是 non-repeaters 和 max-repetitions，其余请求为 0"""
+    varbinds = b"".join(encode_tlv(SEQUENCE, encode_oid(oid) + encode_tlv(NULL, b"")) for oid in oids)
+    pdu = encode_tlv(pdu_type, encode_integer(INTEGER, request_id) + encode_integer(INTEGER, non_repeaters)
+                     + encode_integer(INTEGER, max_repetitions) + encode_tlv(SEQUENCE, varbinds))
+    community = community.encode() if isinstance(community, str) else community
+    return encode_tlv(SEQUENCE, encode_integer(INTEGER, 1) + encode_tlv(OCTET_STRING, community) + pdu)
+
+
+class Varbind:
+    """一个变量绑定，属性与 easysnmp 的 SNMPVariable 相同（oid 为完整数字 OID，oid_index 为空）"""
+    __slots__ = ("oid", "oid_index", "value", "snmp_type")
+
+    def __init__(self, oid, tag, payload):
+        self.oid = ".".join(map(str, oid))
+        self.oid_index = ""
+        self.value = decode_value(tag, payload)
+        self.snmp_type = SNMP_TYPES.get(tag, "UNKNOWN")
+
+
+def decode_response(data):
+    """解析应答报文，返回 (request_id, error_status, error_index, [Varbind, ...])"""
+    _, message, _ = decode_tlv(data, 0)
+    _, _version, offset = decode_tlv(message, 0)
+    _, _community, offset = decode_tlv(message, offset)
+    pdu_type, pdu, _ = decode_tlv(message, offset)
+    if pdu_type != RESPONSE:
+        raise ValueError(f"不是应答报文: {pdu_type:#x}")
+    _, request_id, offset = decode_tlv(pdu, 0)
+    _, error_status, offset = decode_tlv(pdu, offset)
+    _, error_index, offset = decode_tlv(pdu, offset)
+    _, bindings, _ = decode_tlv(pdu, offset)
+    varbinds = []
+    offset = 0
+    while offset < len(bindings):
+        _, binding, offset = decode_tlv(bindings, offset)
+        _, oid, value_offset = decode_tlv(binding, 0)
+        tag, payload, _ = decode_tlv(binding, value_offset)
+        varbinds.append(Varbind(decode_oid(oid), tag, payload))
+    return decode_integer(request_id), decode_integer(error_status), decode_integer(error_index), varbinds
+
+
+# ---- 客户端 ----
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, engine):
+        self.engine = engine
+
+    def datagram_received(self, data, addr):
+        self.engine._dispatch(data, addr)
+
+    def error_received(self, exc):
+        # ICMP 端口不可达等错误：对应的请求按超时处理
+        pass
+
+
+class _HostLimiter:
+    """单台设备的限速：同时在途的请求数和相邻两次请求的最小间隔"""
+
+    def __init__(self, per_host, min_interval):
+        self.semaphore = asyncio.Semaphore(per_host)
+        self.min_interval = min_interval
+        self.next_send = 0.0
+
+    async def wait_turn(self):
+        if not self.min_interval:
+            return
+        now = time.monotonic()
+        send_at = max(now, self.next_send)
+        self.next_send = send_at + self.min_interval
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+
+class AsyncSnmpEngine:
+    """在一个事件循环里收发所有设备的 SNMP 请求
+
+    max_in_flight 限制所有设备合计的在途请求数，per_host 和 min_interval（秒）限制单台设备。
+    必须在事件循环中 await start() 之后使用，用完调用 close()。
+    """
+
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, per_host=DEFAULT_PER_HOST, min_interval=0.0,
+                 port=SNMP_PORT):
+        self.max_in_flight = max(1, max_in_flight)
+        self.per_host = max(1, per_host)
+        self.min_interval = min_interval
+        self.port = port
+        self.transport = None
+        self.pending = {}  # {request_id: (设备地址, Future)}
+        self.limiters = {}
+        self.requests = 0
+        # request-id 从随机值开始，避免与上一次运行迟到的应答混淆
+        self._ids = itertools.count(random.randrange(1, 1 << 30))
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        except OSError:
+            pass
+        sock.bind(("0.0.0.0", 0))
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: _ClientProtocol(self), sock=sock)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        for _, future in self.pending.values():
+            if not future.done():
+                future.cancel()
+        self.pending.clear()
+
+    def _next_id(self):
+        return next(self._ids) & 0x7FFFFFFF or 1
+
+    def _dispatch(self, data, addr):
+        try:
+            request_id, error_status, error_index, varbinds = decode_response(data)
+        except (IndexError, ValueError):
+            return
+        waiting = self.pending.get(request_id)
+        if waiting is None or waiting[0] != addr[0] or waiting[1].done():
+            return
+        waiting[1].set_result((error_status, error_index, varbinds))
+
+    async def request(self, host, community, pdu_type, oids, timeout, retries=0, non_repeaters=0,
+                      max_repetitions=0):
+        """发送一个请求并等待应答，超时后用同一个 request-id 重发 retries 次
+
+        返回 Varbind 列表；error-status 不为 0 时抛出 SnmpError（消息里带 tooBig 等名称），
+        全部超时时抛出 SnmpTimeout。
+        """
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            limiter = self.limiters[host] = _HostLimiter(self.per_host, self.min_interval)
+        request_id = self._next_id()
+        packet = encode_request(community, pdu_type, request_id, oids, non_repeaters, max_repetitions)
+        future = asyncio.get_running_loop().create_future()
+        async with limiter.semaphore, self.in_flight:
+            self.pending[request_id] = (host, future)
+            try:
+                for _ in range(retries + 1):
+                    await limiter.wait_turn()
+                    self.requests += 1
+                    self.transport.sendto(packet, (host, self.port))
+                    try:
+                        error_status, error_index, varbinds = await asyncio.wait_for(
+                            asyncio.shield(future), timeout)
+                        break
+                    except asyncio.TimeoutError:
+                        continue
+                else:
+                    raise SnmpTimeout(f"timed out while waiting for {host}")
+            finally:
+                self.pending.pop(request_id, None)
+        if error_status:
+            name = ERROR_STATUS.get(error_status, f"error-status {error_status}")
+            raise SnmpError(f"{host}: {name} (index {error_index})")
+        return varbinds
+
+
+async def run_bounded(items, limit, handle):
+    """对 items 逐个 await handle(item)，同时最多 limit 个；只创建 limit 个协程，几万个地址也不占多少内存"""
+    iterator = iter(items)
+
+    async def worker():
+        for item in iterator:
+            await handle(item)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(limit, len(items))))))
+
+
+_DONE = object()
+
+def iterate_in_thread(producer):
+    """在后台线程的事件循环里运行 producer(emit)，以普通生成器的形式逐个取出 emit 的结果
+
+    调用方（例如唯一写库的采集线程）不需要是协程；producer 抛出的异常在生成器里重新抛出。
+    """
+    results = queue.Queue()
+    failure = []
+
+    def run():
+        try:
+            asyncio.run(producer(results.put))
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            results.put(_DONE)
+
+    thread = threading.Thread(target=run, name="snmp-async", daemon=True)
+    thread.start()
+    while True:
+        item = results.get()
+        if item is _DONE:
+            break
+        yield item
+    thread.join()
+    if failure:
+        raise failure[0]
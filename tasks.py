@@ -0,0 +1,113 @@
+import datetime
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from collector import collection_lock
+from db import SessionLocal, Task, get_shanghai_time
+
+# 任务队列的默认设置：工作线程数、已结束任务的保留天数
+DEFAULT_TASK_WORKERS = 2
+DEFAULT_TASK_KEEP_DAYS = 7
+
+# 未结束的任务状态
+ACTIVE_STATUSES = ("queued", "running")
+
+class TaskQueue:
+    """进程内的后台任务队列，代替每次请求新开的线程
+
+    - 工作线程数有上限，多出来的任务排队等待；
+    - 相同 key 的任务还没结束时再次提交，直接返回已有任务（例如同一网段的重复采集请求）；
+    - exclusive 任务（采集、清理）运行时持有 collector.collection_lock，互相串行，
+      也不会和定时的到期设备轮询同时写库；
+    - 任务状态保存在 tasks 表里，重启后仍可查询，已结束的任务保留 keep_days 天。
+    """
+
+    def __init__(self, workers=DEFAULT_TASK_WORKERS, keep_days=DEFAULT_TASK_KEEP_DAYS):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="task")
+        self.keep_days = keep_days
+        self.lock = threading.Lock()
+
+    def interrupt_unfinished(self):
+        """上次进程退出时没跑完的任务不会再执行，标记为失败
+
+        只能在 Web 服务启动时调用：flask --app app export/collect 等命令也会导入 app，
+        那时正在运行的服务里的任务并没有中断。
+        """
+        db = SessionLocal()
+        try:
+            db.query(Task).filter(Task.status.in_(ACTIVE_STATUSES)).update(
+                {"status": "failed", "message": "服务重启，任务已中断", "finished_at": get_shanghai_time()},
+                synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def submit(self, kind, key, func, *args, message="", exclusive=True):
+        """提交任务，返回任务 id；相同 key 的任务未结束时返回该任务的 id
+
+        func(*args) 的返回值（字符串）作为任务完成时的消息，抛出异常时任务标记为失败。
+        """
+        with self.lock:
+            db = SessionLocal()
+            try:
+                existing = db.query(Task.id).filter(Task.key == key, Task.status.in_(ACTIVE_STATUSES)).first()
+                if existing:
+                    return existing.id
+                task_id = uuid.uuid4().hex
+                db.add(Task(id=task_id, kind=kind, key=key, status="queued", message=message or "排队中..."))
+                db.commit()
+            finally:
+                db.close()
+        self.executor.submit(self._run, task_id, func, args, exclusive)
+        return task_id
+
+    def _run(self, task_id, func, args, exclusive):
+        try:
+            if exclusive:
+                with collection_lock:
+                    self._update(task_id, status="running", started_at=get_shanghai_time())
+                    result = func(*args)
+            else:
+                self._update(task_id, status="running", started_at=get_shanghai_time())
+                result = func(*args)
+            self._update(task_id, status="completed", message=result, finished_at=get_shanghai_time())
+        except Exception as e:
+            self._update(task_id, status="failed", message=str(e), finished_at=get_shanghai_time())
+        self._prune()
+
+    def _update(self, task_id, **values):
+        db = SessionLocal()
+        try:
+            db.query(Task).filter(Task.id == task_id).update(values, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _prune(self):
+        """删除超过保留天数的已结束任务"""
+        cutoff = get_shanghai_time() - datetime.timedelta(days=self.keep_days)
+        db = SessionLocal()
+        try:
+            db.query(Task).filter(Task.finished_at < cutoff).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def status(self, task_id):
+        """返回任务状态字典，任务不存在时返回 None"""
+        db = SessionLocal()
+        try:
+            task = db.get(Task, task_id)
+            if task is None:
+                return None
+            return {
+                "id": task.id,
+                "kind": task.kind,
+                "status": task.status,
+                "message": task.message,
+                "created_at": task.created_at.isoformat() if task.created_at else None,
+                "started_at": task.started_at.isoformat() if task.started_at else None,
+                "finished_at": task.finished_at.isoformat() if task.finished_at else None,
+            }
+        finally:
+            db.close()